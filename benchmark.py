@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import argparse
+import tempfile
+
+import script
+
+MODEL_FILES = ('model.nmf', 'model_lod1.nmf', 'model_lod2.nmf', 'model_emissive.nmf')
+TEXTURE_FILES = ('texture.dds', 'texture_n.dds', 'texture_s.dds', 'texture_e.dds')
+
+def building_ini_text(rng, type_value, subtype_value, name):
+    lines = ['$NAME_STR "{}"\n'.format(name), type_value + '\n']
+    if subtype_value:
+        lines.append(subtype_value + '\n')
+    lines += [
+        '$WORKERS_NEEDED {}\n'.format(rng.randint(5, 200)),
+        '$PROFESSORS_NEEDED {}\n'.format(rng.randint(0, 20)),
+        '$ELETRIC_CONSUMPTION_LIGHTING_WORKER_FACTOR 0.5\n',
+        '$ELETRIC_CONSUMPTION_LIVING_WORKER_FACTOR 0.3\n',
+        '$HEATING_ENABLE\n',
+        '$CONNECTION_PEDESTRIAN 10 0 5 10 0 6\n',
+        '$CONNECTION_ROAD 12 0 8 14 0 8\n',
+        '$CONNECTION_ROAD_DEAD 12 0 8\n',
+        '$COST_WORK SOVIET_CONSTRUCTION_GROUNDWORKS {}\n'.format(rng.randint(10, 500)),
+        '$COST_WORK SOVIET_CONSTRUCTION_STEEL {}\n'.format(rng.randint(10, 500)),
+        '$COST_WORK SOVIET_CONSTRUCTION_BRICKS {}\n'.format(rng.randint(10, 500)),
+        '$COST_WORK_BUILDING_NODE node_walls\n',
+        '$COST_RESOURCE_AUTO ground_asphalt 1.0\n',
+        '$COST_RESOURCE steel {}\n'.format(rng.randint(1, 100)),
+        '$COST_RESOURCE bricks {}\n'.format(rng.randint(1, 100)),
+        '$COUNT_LIMIT {}\n'.format(rng.randint(1, 10)),
+    ]
+    lines += ['$PARTICLE {} 0 {} 0.5\n'.format(rng.random(), rng.random()) for i in range(rng.randint(5, 40))]
+    lines += ['$STORAGE_SPECIAL 0 RESOURCE_TRANSPORT_GENERAL {}\n'.format(rng.randint(1, 50))]
+    return ''.join(lines)
+
+def generate_tree(path, count, seed=0, filler_files=4, filler_size=4096):
+    # Create count asset folders with a building.ini, filler model and
+    # texture files and a workshopconfig.ini listing them
+    rng = random.Random(seed)
+    type_subtypes = sorted(script.TYPE_SUBTYPE_NAMES)
+    types = sorted(script.TYPE_NAMES)
+    filler = os.urandom(filler_size)
+    folder_names = []
+    for i in range(count):
+        if rng.random() < 0.3:
+            type_value, subtype_value = rng.choice(type_subtypes)
+        else:
+            type_value, subtype_value = rng.choice(types), ''
+        folder_name = 'asset{:06d}'.format(i)
+        folder = os.path.join(path, folder_name)
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'building.ini'), 'w') as f:
+            f.write(building_ini_text(rng, type_value, subtype_value, 'Asset {}'.format(i)))
+        for name in (MODEL_FILES + TEXTURE_FILES)[:filler_files]:
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(filler)
+        folder_names.append(folder_name)
+    with open(os.path.join(path, 'workshopconfig.ini'), 'w') as f:
+        f.write('$ITEM_ID 1234567890\n')
+        f.write('$OWNER_ID 76561198000000000\n')
+        f.write('$ITEM_NAME "Synthetic benchmark collection"\n')
+        f.write('$ITEM_DESC "Generated by benchmark.py"\n')
+        f.write('$VISIBILITY 0\n')
+        for folder_name in folder_names:
+            f.write('$OBJECT_BUILDING {}\n'.format(folder_name))
+        f.write('$END\n')
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+def timed_operation(timings, phases, label, working_directory, operation, **options):
+    metrics = script.Metrics()
+    timings[label], _ = timed(script.run_operation, working_directory, operation, metrics=metrics, **options)
+    phases[label] = metrics.to_dict()['phases']
+
+def run_benchmark(size, workers=1, executor='thread', seed=0, filler_files=4):
+    # Time one run over a fresh tree. Returns {step: seconds} and the phases
+    # of each operation as {step: {phase: seconds}}.
+    timings = {}
+    phases = {}
+    temp_dir = tempfile.mkdtemp(prefix='iniconfig-bench-')
+    working_directory = os.path.join(temp_dir, 'collection')
+    os.makedirs(working_directory)
+    cwd = os.getcwd()
+    try:
+        # iniconfig.log is written to the current directory
+        os.chdir(temp_dir)
+        options = {'workers': workers, 'executor': executor}
+        timings['generate'], _ = timed(generate_tree, working_directory, size, seed, filler_files)
+        timings['discover'], _ = timed(script.discover_assets, working_directory)
+        timed_operation(timings, phases, 'modify', working_directory, 'modify', incremental=True, **options)
+        timed_operation(timings, phases, 'modify (rerun)', working_directory, 'modify', incremental=True,
+                        **options)
+        timed_operation(timings, phases, 'restore', working_directory, 'restore', **options)
+        timed_operation(timings, phases, 'rename-by-type', working_directory, 'rename-by-type', prefix='Bench',
+                        **options)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(temp_dir)
+    return timings, phases
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Time wrsr-iniconfig operations on generated asset trees.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help="numbers of assets to generate (default: 100 1000 10000)")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="runs per size; the fastest time of each phase is reported (default: 1)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="workers passed to the operations (default: 1)")
+    parser.add_argument('--executor', choices=('thread', 'process'), default='thread')
+    parser.add_argument('--filler-files', type=int, default=4,
+                        help="model and texture files per asset folder (default: 4)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--phases', action='store_true',
+                        help="also print the time of each phase of the operations")
+    parser.add_argument('--json', action='store_true',
+                        help="print the results as JSON")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    results = []
+    for size in args.sizes:
+        best = {}
+        best_phases = {}
+        for i in range(args.repeat):
+            timings, phases = run_benchmark(size, args.workers, args.executor, args.seed, args.filler_files)
+            for step, seconds in timings.items():
+                if seconds <= best.get(step, seconds):
+                    best[step] = seconds
+                    if step in phases:
+                        best_phases[step] = phases[step]
+        results.append({'assets': size, 'seconds': best, 'phases': best_phases})
+        if not args.json:
+            print("{} assets".format(size))
+            for step, seconds in best.items():
+                print("    {:<20} {:9.3f} s  {:10.0f} assets/s".format(
+                    step, seconds, size / seconds if seconds else 0))
+                if args.phases:
+                    for phase, phase_seconds in best_phases.get(step, {}).items():
+                        print("        {:<18} {:9.3f} s".format(phase, phase_seconds))
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,180 @@ import os
 import sys
 import time
 import datetime
-import shutil
-import random
 import re
+import json
+import argparse
+import concurrent.futures
+import hashlib
+import threading
+import atexit
+import heapq
+import contextlib
+import importlib
+import sqlite3
+import shutil
+import zipfile
+import posixpath
+import queue
+import collections
+import csv
+
+# Asset names by building type, shared by the rename operations
+TYPE_SUBTYPE_NAMES = {
+    ('$TYPE_UNIVERSITY', '$SUBTYPE_MEDICAL'): 'Medical University',
+    ('$TYPE_UNIVERSITY', '$SUBTYPE_TECHNICAL'): 'Technical University',
+    ('$TYPE_UNIVERSITY', '$SUBTYPE_SOVIET'): 'Party HQ',
+    ('$TYPE_LIVING', '$SUBTYPE_HOSTEL'): 'Hostel',
+    ('$TYPE_BROADCAST', '$SUBTYPE_RADIO'): 'Radio station',
+    ('$TYPE_BROADCAST', '$SUBTYPE_TELEVISION'): 'Television station',
+    ('$TYPE_STORAGE', '$SUBTYPE_SPACE_FOR_VEHICLES'): 'Vehicle storage',
+    ('$TYPE_PRODUCTION_LINE', '$SUBTYPE_ROAD'): 'Vehicle production line',
+    ('$TYPE_PRODUCTION_LINE', '$SUBTYPE_AIRPLANE'): 'Aircraft production line',
+    ('$TYPE_PRODUCTION_LINE', '$SUBTYPE_RAIL'): 'Locomotive/car production line',
+    ('$TYPE_ROADDEPO', '$SUBTYPE_TROLLEYBUS'): 'Trolleybus depot',
+    ('$TYPE_ROADDEPO', '$SUBTYPE_TRAM'): 'Tram depot',
+    ('$TYPE_RAIL_TRAFO', '$SUBTYPE_ROAD'): 'Trolleybus trafo',
+    ('$TYPE_PASSANGER_STATION', '$SUBTYPE_CABLEWAY'): 'Cableway passenger station',
+    ('$TYPE_PASSANGER_STATION', '$SUBTYPE_SHIP'): 'Ferry terminal',
+    ('$TYPE_PASSANGER_STATION', '$SUBTYPE_AIRPLANE'): 'Airport terminal',
+    ('$TYPE_PASSANGER_STATION', '$SUBTYPE_METRO'): 'Metro station',
+    ('$TYPE_CARGO_STATION', '$SUBTYPE_CABLEWAY'): 'Cableway cargo station',
+    ('$TYPE_CARGO_STATION', '$SUBTYPE_AIRPLANE'): 'Airplane cargo station',
+    ('$TYPE_CARGO_STATION', '$SUBTYPE_SHIP'): 'Seaport (experimental)',
+    ('$TYPE_ENGINE', '$SUBTYPE_CABLEWAY'): 'Cableway engine',
+    ('$TYPE_CONSTRUCTION_OFFICE', '$SUBTYPE_AIRPLANE'): 'Helicopter construction office',
+    ('$TYPE_WATER_PUMP', '$SUBTYPE_WATER_SWITCH'): 'Water switch',
+    ('$TYPE_TRANSFORMATOR', '$SUBTYPE_PRIORITY_1'): 'Priority switch',
+    ('$TYPE_WAITING_STATION', '$SUBTYPE_METRO'): 'Metro end station',
+    ('$TYPE_ELETRIC_EXPORT', '$SUBTYPE_OWN_CUSTOM'): 'Custom electric export',
+}
+
+TYPE_NAMES = {
+    '$TYPE_AIRPLANE_GATE': 'Aircraft gate',
+    '$TYPE_AIRPLANE_PARKING': 'Aircraft parking',
+    '$TYPE_AIRPLANE_TOWER': 'Aircraft tower',
+    '$TYPE_ATTRACTION': 'Attraction',
+    '$TYPE_BROADCAST': 'Broadcast',
+    '$TYPE_CAR_DEALER': 'Car dealer',
+    '$TYPE_CARGO_STATION': 'Cargo station',
+    '$TYPE_CHURCH': 'Church',
+    '$TYPE_CITYHALL': 'City hall',
+    '$TYPE_CONSTRUCTION_OFFICE': 'Construction office',
+    '$TYPE_CONSTRUCTION_OFFICE_RAIL': 'Rail construction office',
+    '$TYPE_CONTAINER_FACILITY': 'Container facility',
+    '$TYPE_COOLING_TOWER': 'Cooling tower',
+    '$TYPE_COURT_HOUSE': 'Court house',
+    '$TYPE_CUSTOMHOUSE': 'Custom house',
+    '$TYPE_DEMOLITION_OFFICE': 'Demolition office',
+    '$TYPE_DISTRIBUTION_OFFICE': 'Distribution office',
+    '$TYPE_DISTRIBUTION_OFFICE_RAIL': 'Rail distribution office',
+    '$TYPE_ELETRIC_EXPORT': 'Electric export',
+    '$TYPE_ELETRIC_IMPORT': 'Electric import',
+    '$TYPE_ENGINE': 'Engine',
+    '$TYPE_FACTORY': 'Factory',
+    '$TYPE_FARM': 'Farm',
+    '$TYPE_FIELD': 'Field',
+    '$TYPE_FIRESTATION': 'Fire station',
+    '$TYPE_FOREIGN_PIPELINE_EXPORT': 'Foreign pipeline export',
+    '$TYPE_FORKLIFT_GARAGE': 'Forklift garage',
+    '$TYPE_GARBAGE_OFFICE': 'Garbage office',
+    '$TYPE_GAS_STATION': 'Gas station',
+    '$TYPE_HEATING_ENDSTATION': 'Heating end station',
+    '$TYPE_HEATING_PLANT': 'Heating plant',
+    '$TYPE_HEATING_SWITCH': 'Heating switch',
+    '$TYPE_HOSPITAL': 'Hospital',
+    '$TYPE_HOTEL': 'Hotel',
+    '$TYPE_KINDERGARTEN': 'Kindergarten',
+    '$TYPE_KINO': 'Cinema',
+    '$TYPE_LIVING': 'Residential',
+    '$TYPE_MINE_BAUXITE': 'Bauxite mine',
+    '$TYPE_MINE_COAL': 'Coal mine',
+    '$TYPE_MINE_GRAVEL': 'Gravel mine',
+    '$TYPE_MINE_IRON': 'Iron mine',
+    '$TYPE_MINE_OIL': 'Oil rig/pumpjack',
+    '$TYPE_MINE_URANIUM': 'Uranium mine',
+    '$TYPE_MINE_WATER': 'Water pump',
+    '$TYPE_MINE_WATER_SURFACE': 'Surface water pump',
+    '$TYPE_MINE_WOOD': 'Woodcutter',
+    '$TYPE_MONUMENT': 'Monument',
+    '$TYPE_ORPHANAGE': 'Orphanage',
+    '$TYPE_PARKING': 'Parking',
+    '$TYPE_PASSANGER_STATION': 'Passenger station',
+    '$TYPE_PEDESTRIAN_BRIDGE': 'Pedestrian bridge',
+    '$TYPE_POLICE_STATION': 'Police station',
+    '$TYPE_POLLUTION_METER': 'Pollution meter',
+    '$TYPE_POWERPLANT': 'Power plant',
+    '$TYPE_PRISON': 'Prison',
+    '$TYPE_PRODUCTION_LINE': 'Production line',
+    '$TYPE_PUB': 'Pub',
+    '$TYPE_RAIL_TRAFO': 'Rail transformer',
+    '$TYPE_RAILDEPO': 'Rail depot',
+    '$TYPE_REPAIR_OFFICE': 'Repair office',
+    '$TYPE_ROADDEPO': 'Road depot',
+    '$TYPE_SCHOOL': 'School',
+    '$TYPE_SCRAPYARD': 'Scrapyard',
+    '$TYPE_SECRET_POLICE': 'Secret police',
+    '$TYPE_SEWAGE_DISCHARGE': 'Sewage discharge',
+    '$TYPE_SEWAGE_ENDSTATION': 'Sewage reservoir',
+    '$TYPE_SEWAGE_PUMP': 'Sewage pump',
+    '$TYPE_SEWAGE_TREATMENT': 'Sewage treatment',
+    '$TYPE_SHIP_DOCK': 'Ship dock',
+    '$TYPE_SHOP': 'Shop',
+    '$TYPE_SPORT': 'Sport',
+    '$TYPE_STORAGE': 'Storage',
+    '$TYPE_SUBSTATION': 'Substation',
+    '$TYPE_TRAM_GATE': 'Tram gate',
+    '$TYPE_TRANSFORMATOR': 'Transformer',
+    '$TYPE_TRASH_CONTAINER': 'Trash container',
+    '$TYPE_UNIVERSITY': 'University',
+    '$TYPE_WAITING_STATION': 'Waiting station',
+    '$TYPE_WATER_ENDSTATION': 'Water reservoir',
+    '$TYPE_WATER_PUMP': 'Water pump',
+    '$TYPE_WATER_SWITCH': 'Water switch',
+    '$TYPE_WATER_TREATMENT': 'Water treatment',
+}
+
+# The free building conversion as a profile (see Profile). A * at the end
+# matches every directive starting with the rest, e.g. $COST_WORK_VEHICLE_STATION.
+FREE_PROFILE = {
+    'remove': [
+        '$COST_WORK*', '$COST_RESOURCE*', '$NO_LIFESPAN', '$HEATING_DISABLE',
+        '$WATERSEWAGE_DISABLE', '$WASTE_WORKERS_DISABLE', '$WASTE_CUSTOMERS_DISABLE',
+        '$COUNT_LIMIT', '$ELETRIC_WITHOUT_WORKING_FACTOR', '$ELETRIC_WITHOUT_LIGHTING_FACTOR',
+    ],
+    'insert_after': {
+        'name': [
+            '$NO_LIFESPAN',
+            '$HEATING_DISABLE',
+            '$WATERSEWAGE_DISABLE',
+            '$WASTE_WORKERS_DISABLE',
+            '$WASTE_CUSTOMERS_DISABLE',
+            '$COUNT_LIMIT 999',
+            '$ELETRIC_WITHOUT_WORKING_FACTOR 1',
+            '$ELETRIC_WITHOUT_LIGHTING_FACTOR 1',
+        ],
+    },
+}
+PROFILE_KEYS = {'remove': list, 'replace': dict, 'set': dict, 'insert_after': dict}
+NAME_DIRECTIVES = frozenset(('$NAME_STR', '$NAME'))
+
+# Bump when the conversion output changes so incremental runs redo all assets
+TRANSFORM_VERSION = 2
+STATE_DIRNAME = '.iniconfig'
+# Assets queued between the discovery thread and the workers
+PIPELINE_DEPTH = 256
+# building.ini and workshopconfig.ini are handled as bytes in whatever encoding
+# they are in. Names are decoded as UTF-8, or else in the encoding most
+# workshop files that are not UTF-8 use.
+UTF8_BOM = b'\xef\xbb\xbf'
+LEGACY_ENCODING = 'cp1251'
+NEWLINE_PATTERN = re.compile(rb'\r\n|\r|\n')
+# Backups written next to building.ini by older versions
+BACKUP_PATTERN = re.compile(r'building\.\d{8}\.bak')
+
+WORKSHOP_URL = 'https://steamcommunity.com/sharedfiles/filedetails/?id='
+ITEM_DIRECTIVES = {b'$ITEM_ID': 0, b'$ITEM_NAME': 1, b'$ITEM_DESC': 2}
+OPERATIONS = ('modify', 'rename-by-type', 'rename-individually', 'restore', 'list', 'undo')
 
 def clear_screen():
     os.system('cls' if os.name == 'nt' else 'clear')
@@ -15,24 +186,466 @@ def exit_script():
     print("Exiting...")
     sys.exit(0)
 
+class IniconfigLog:
+    # Append-only log. Messages are buffered and appended in batches; when the
+    # file grows past max_bytes it is moved to <path>.1, so at most two files
+    # of history are kept.
+    def __init__(self, path, max_bytes=16 * 1024, flush_lines=50):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_lines = flush_lines
+        self.buffer = []
+        self.lock = threading.Lock()
+
+    def write(self, message):
+        line = "[{date}], [{time}], {message}\n".format(
+            date=datetime.date.today().isoformat(), time=time.strftime("%H:%M:%S"), message=message)
+        with self.lock:
+            self.buffer.append(line)
+            if len(self.buffer) >= self.flush_lines:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        lines = self.buffer
+        self.buffer = []
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = None
+        if size is not None and size >= self.max_bytes:
+            os.replace(self.path, self.path + '.1')
+            size = 0
+        if size is None:
+            lines.insert(0, "[{date}], [{time}], iniconfig created logfile\n".format(
+                date=datetime.date.today().isoformat(), time=time.strftime("%H:%M:%S")))
+        with open(self.path, 'a') as f:
+            f.writelines(lines)
+
+    def read(self, limit=100):
+        # Newest first, like the log files written by older versions
+        self.flush()
+        lines = []
+        for path in (self.path + '.1', self.path):
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    lines.extend(f.readlines())
+        # Sorting by the [date], [time] prefix also orders old newest-first
+        # files. The sort is stable, so lines of the same second stay in
+        # reverse order of writing.
+        lines.reverse()
+        lines.sort(key=lambda line: line[:26], reverse=True)
+        return lines[:limit]
+
+LOG = IniconfigLog('iniconfig.log')
+atexit.register(LOG.flush)
+
 def update_log(message):
-    log_path = 'iniconfig.log'
-    date_str = datetime.date.today().isoformat()
-    time_str = time.strftime("%H:%M:%S")
-    if os.path.exists(log_path):
-        with open(log_path, 'r') as f:
-            log_lines = f.readlines()
-        if len(log_lines) >= 100:
-            log_lines = log_lines[:-1]
+    LOG.write(message)
+
+def read_log(limit=100):
+    return LOG.read(limit)
+
+def make_result(operation, working_directory, success_dirs, failed_dirs, skipped_dirs=(), metrics=None):
+    return {
+        'operation': operation,
+        'working_directory': working_directory,
+        'success': list(success_dirs),
+        'failed': [{'path': path, 'error': error} for path, error in failed_dirs],
+        'skipped': list(skipped_dirs),
+        'metrics': metrics.to_dict() if metrics is not None else None,
+    }
+
+def run_operation(working_directory, operation, prefix='', names=None, **options):
+    # options: workers, executor, max_depth, metrics, types, catalog, durability,
+    # incremental and profile (conversions), date and run_id (restore), output
+    # (archives). working_directory may also be a zip archive.
+    if is_archive(working_directory):
+        try:
+            return convert_archive(working_directory, operation, prefix=prefix, names=names, **options)
+        finally:
+            LOG.flush()
+    if not os.path.isdir(working_directory):
+        raise ValueError("Invalid directory: {}".format(working_directory))
+    try:
+        if operation == 'modify':
+            return modify_building_ini_only(working_directory, interactive=False, **options)
+        elif operation == 'rename-by-type':
+            return rename_assets_by_type(working_directory, prefix=prefix, interactive=False, **options)
+        elif operation == 'rename-individually':
+            return rename_assets_individually(working_directory, names=names, interactive=False, **options)
+        elif operation == 'restore':
+            return restore_backups(working_directory, interactive=False, **options)
+        elif operation == 'list':
+            return list_assets(working_directory, **options)
+        elif operation == 'undo':
+            return undo_run(working_directory, **options)
+    finally:
+        LOG.flush()
+    raise ValueError("Unknown operation: {}".format(operation))
+
+def iter_operation(working_directory, operation, prefix='', names=None, **options):
+    # Like run_operation, but yields a record for each asset as soon as it
+    # is done instead of returning the lists at the end
+    if not os.path.isdir(working_directory):
+        raise ValueError("Invalid directory: {}".format(working_directory))
+    if operation not in OPERATIONS:
+        raise ValueError("Unknown operation: {}".format(operation))
+    update_log("iniconfig check: {} (streamed)".format(operation))
+    try:
+        if operation == 'restore':
+            for record in iter_restore(working_directory, **options):
+                yield record
+        elif operation == 'list':
+            for row in list_assets(working_directory, **options)['assets']:
+                yield row
+        elif operation == 'undo':
+            for record in iter_undo(working_directory, **options):
+                yield record
+        else:
+            for record in iter_convert(working_directory, operation, prefix, names, **options):
+                yield record
+    finally:
+        LOG.flush()
+
+def report_operation(working_directory, operation, report, prefix='', names=None, root_path=False, **options):
+    # Run an operation with its records going to report as they come in,
+    # instead of being collected in lists. With root_path, the reported
+    # paths include the working directory.
+    base = working_directory if root_path else None
+    if is_archive(working_directory):
+        # Archives are converted in one go; their records follow the result
+        result = run_operation(working_directory, operation, prefix, names, **options)
+        for path in result['success']:
+            report.add(asset_record(path, 'converted'), base)
+        for failure in result['failed']:
+            report.add(asset_record(failure['path'], 'failed', failure['error']), base)
+        update_log("Converted archive written to {}".format(result['output']))
+        return
+    for record in iter_operation(working_directory, operation, prefix, names, **options):
+        report.add(record, base)
+
+def root_result(working_directory, result):
+    # Summary of one root of run_roots
+    summary = {'working_directory': working_directory, 'success': len(result['success']),
+               'failed': len(result['failed']), 'skipped': len(result['skipped'])}
+    if 'output' in result:
+        summary['output'] = result['output']
+    return summary
+
+def run_roots(roots, operation, prefix='', names=None, state_dir=None, root_workers=4, metrics=None, report=None,
+              **options):
+    # run_operation on several directories or archives, root_workers of them
+    # at a time, with one combined result whose paths include their root.
+    # With a report, the records go there and the report's summary is
+    # returned instead.
+    # With state_dir the roots share one manifest, backup store and catalog
+    # there, loaded and saved once for the batch; otherwise each keeps its
+    # own .iniconfig. With workers > 1 one pool serves all roots, so the
+    # worker processes start only once.
+    if metrics is None:
+        metrics = Metrics()
+    roots = list(dict.fromkeys(os.path.abspath(root) for root in roots))
+    for root in roots:
+        if not os.path.isdir(root) and not is_archive(root):
+            raise ValueError("Invalid directory: {}".format(root))
+    if operation not in OPERATIONS:
+        raise ValueError("Unknown operation: {}".format(operation))
+    if len(roots) > 1 and options.get('output'):
+        raise ValueError("--output only works with a single archive")
+    workers = options.get('workers', 1)
+    pool = None
+    if workers > 1:
+        if options.get('executor') == 'process':
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        options['executor'] = pool
+    run_state = None
+    if state_dir is not None:
+        with metrics.phase('load state'):
+            run_state = RunState(None, os.path.abspath(state_dir),
+                                 incremental=options.get('incremental', False),
+                                 catalog=operation == 'list' or options.get('catalog') or bool(options.get('types')),
+                                 durability=options.get('durability', 'none'))
+
+    def run_root(root):
+        root_options = dict(options)
+        if not is_archive(root):
+            # --output is for the archives among the roots
+            root_options.pop('output', None)
+        try:
+            if report is not None:
+                return report_operation(root, operation, report, prefix, names, root_path=True, metrics=metrics,
+                                        run_state=run_state, **root_options)
+            return run_operation(root, operation, prefix, names, metrics=metrics, run_state=run_state,
+                                 **root_options)
+        except (OSError, ValueError) as e:
+            # One root failing does not stop the others
+            if report is not None:
+                return report.add(asset_record(root, 'failed', e))
+            return make_result(operation, root, [], [('', str(e))])
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(root_workers, len(roots)))) as roots_pool:
+            results = list(roots_pool.map(run_root, roots))
+    finally:
+        if run_state is not None:
+            if operation == 'undo':
+                run_state.journal.mark_settled()
+            run_state.save(metrics)
+        if pool is not None:
+            pool.shutdown()
+    if report is not None:
+        summary = report.summary(operation, metrics)
+        summary['working_directories'] = roots
+        return summary
+    success_dirs = []
+    failed_dirs = []
+    skipped_dirs = []
+    for root, result in zip(roots, results):
+        success_dirs.extend(os.path.join(root, path) for path in result['success'])
+        failed_dirs.extend((os.path.join(root, failure['path']) if failure['path'] else root, failure['error'])
+                           for failure in result['failed'])
+        skipped_dirs.extend(os.path.join(root, path) for path in result['skipped'])
+    combined = make_result(operation, None, success_dirs, failed_dirs, skipped_dirs, metrics)
+    combined['working_directories'] = roots
+    combined['roots'] = [root_result(root, result) for root, result in zip(roots, results)]
+    if operation == 'restore':
+        combined['restored'] = [{'date': restored['date'], 'path': os.path.join(root, restored['path'])}
+                                for root, result in zip(roots, results) for restored in result.get('restored', ())]
+        combined['no_backup'] = [os.path.join(root, path)
+                                 for root, result in zip(roots, results) for path in result.get('no_backup', ())]
+    elif operation == 'list':
+        combined['assets'] = [dict(row, path=os.path.join(root, row['path']))
+                              for root, result in zip(roots, results) for row in result.get('assets', ())]
+    return combined
+
+def parse_name(value):
+    folder, sep, name = value.partition('=')
+    if not sep or not folder or not name.strip():
+        raise argparse.ArgumentTypeError("expected FOLDER=NAME, got {!r}".format(value))
+    return folder, name.strip()
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Modify Workers and Resources: Soviet Republic building.ini files without prompts. "
+                    "Run without arguments for the interactive menu.")
+    parser.add_argument('operation', choices=OPERATIONS,
+                        help="operation to run on the working directory")
+    parser.add_argument('working_directories', nargs='*', metavar='working_directory',
+                        help="directory, or zip archive, to modify (default: current directory). Several "
+                             "can be given; they are processed at the same time and reported together.")
+    parser.add_argument('--state-dir', metavar='PATH',
+                        help="keep the manifest, backups and catalog of all working directories in this "
+                             "one folder instead of each directory's .iniconfig")
+    parser.add_argument('--root-workers', type=int, default=4,
+                        help="number of working directories processed at the same time (default: 4)")
+    parser.add_argument('--output', metavar='PATH',
+                        help="where to write the converted archive when the working directory is a zip "
+                             "archive (default: NAME.converted.zip next to it)")
+    parser.add_argument('--prefix', default='',
+                        help="prefix for asset names (rename-by-type)")
+    parser.add_argument('--name', dest='names', action='append', type=parse_name, default=[],
+                        metavar='FOLDER=NAME',
+                        help="new name for an asset folder, or for all assets of a workshop item by its "
+                             "ID (rename-individually); assets without a name get their building type as "
+                             "name. Can be repeated.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of assets converted at the same time (default: 1)")
+    parser.add_argument('--executor', choices=('thread', 'process'), default='thread',
+                        help="run workers as threads or processes (default: thread)")
+    parser.add_argument('--profile', metavar='PATH',
+                        help="JSON rule set to convert building.ini files with (default: the built-in "
+                             "free building profile)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="skip assets that were converted the same way before and have not changed since")
+    parser.add_argument('--date', metavar='YYYYMMDD',
+                        help="restore the newest backup made on this date (restore; default: newest backup)")
+    parser.add_argument('--run', metavar='RUN_ID',
+                        help="restore the backups made by this run (restore), or the run to undo "
+                             "(undo; default: the last run not undone yet)")
+    parser.add_argument('--type', dest='types', action='append', default=[], metavar='TYPE',
+                        help="only handle assets of this building type, e.g. SHOP or $TYPE_SHOP. "
+                             "Can be repeated.")
+    parser.add_argument('--catalog', action='store_true',
+                        help="keep the asset catalog in .iniconfig/catalog.sqlite up to date "
+                             "(always done with --type and by list)")
+    parser.add_argument('--max-depth', type=int, default=None,
+                        help="how many folders deep below the working directory to look for assets "
+                             "(default: no limit)")
+    parser.add_argument('--durability', choices=DURABILITY_MODES, default='none',
+                        help="when written files are synced to disk: 'none' leaves it to the operating "
+                             "system, 'run' syncs them all at the end of the run, 'file' syncs each file "
+                             "as it is written (default: none)")
+    parser.add_argument('--metrics-json', metavar='PATH',
+                        help="write timings per phase, counters and the slowest assets to PATH as JSON")
+    parser.add_argument('--slow-asset-seconds', type=float, default=1.0,
+                        help="assets taking at least this long are listed in the metrics (default: 1.0)")
+    parser.add_argument('--metrics-hook', dest='metrics_hooks', action='append', default=[],
+                        metavar='MODULE:NAME',
+                        help="object (or class) with on_phase, on_count and/or on_asset methods that "
+                             "receives metrics as they are recorded. Can be repeated.")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep running and modify asset folders as they appear or change (modify)")
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help="seconds between two looks at the working directory with --watch (default: 5)")
+    parser.add_argument('--debounce', type=float, default=2.0,
+                        help="with --watch, wait until nothing changed for this many seconds before "
+                             "converting (default: 2)")
+    parser.add_argument('--report', metavar='PATH',
+                        help="write one line per asset to PATH ('-' for standard output) while the run goes "
+                             "on, and print only a summary at the end")
+    parser.add_argument('--report-format', choices=REPORT_FORMATS,
+                        help="format of --report: JSON Lines or CSV (default: csv for a .csv file, else jsonl)")
+    parser.add_argument('--json', action='store_true',
+                        help="print the result as JSON")
+    return parser.parse_args(argv)
+
+def run_batch_mode(argv):
+    args = parse_args(argv)
+    roots = args.working_directories or [os.getcwd()]
+    try:
+        metrics = Metrics(args.slow_asset_seconds, hooks=[load_hook(spec) for spec in args.metrics_hooks])
+        options = {'workers': args.workers, 'executor': args.executor, 'max_depth': args.max_depth,
+                   'metrics': metrics, 'types': args.types}
+        if args.operation == 'undo':
+            # Undo only replays the journal
+            options = {'metrics': metrics, 'durability': args.durability, 'run_id': args.run}
+        elif args.operation != 'list':
+            options.update(durability=args.durability, catalog=args.catalog)
+        if args.operation == 'restore':
+            options.update(date=args.date, run_id=args.run)
+        elif args.operation not in ('list', 'undo'):
+            options.update(incremental=args.incremental, profile=load_profile(args.profile))
+        if any(is_archive(root) for root in roots):
+            options['output'] = args.output
+        if args.watch:
+            if args.operation != 'modify':
+                raise ValueError("--watch only works with modify")
+            if len(roots) > 1 or args.state_dir:
+                raise ValueError("--watch only works with a single working directory")
+            if not os.path.isdir(roots[0]):
+                raise ValueError("Invalid directory: {}".format(roots[0]))
+            del options['incremental']
+            return run_watch_mode(roots[0], args, options)
+        if args.report:
+            return run_report_mode(roots, args, options)
+        if len(roots) > 1 or args.state_dir:
+            result = run_roots(roots, args.operation, prefix=args.prefix, names=dict(args.names),
+                               state_dir=args.state_dir, root_workers=args.root_workers, **options)
+        else:
+            result = run_operation(roots[0], args.operation, prefix=args.prefix, names=dict(args.names),
+                                   **options)
+    except (ValueError, ImportError, AttributeError, OSError) as e:
+        # OSError: e.g. a state folder that cannot be created
+        print(e, file=sys.stderr)
+        return 2
+    if args.metrics_json:
+        metrics.dump_json(args.metrics_json)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_result(result)
+    return 1 if result['failed'] else 0
+
+def run_report_mode(roots, args, options):
+    # Stream the records to the --report file and print the summary
+    report_format = args.report_format or ('csv' if args.report.lower().endswith('.csv') else 'jsonl')
+    fields = LIST_FIELDS if args.operation == 'list' else REPORT_FIELDS
+    if args.report == '-':
+        stream = sys.stdout
+        # The records take standard output
+        summary_file = sys.stderr
+    else:
+        try:
+            stream = open(args.report, 'w', newline='', encoding='utf-8')
+        except OSError as e:
+            raise ValueError("Cannot write report {}: {}".format(args.report, e))
+        summary_file = sys.stdout
+    metrics = options['metrics']
+    try:
+        report = Report(stream, report_format, fields)
+        if len(roots) > 1 or args.state_dir:
+            summary = run_roots(roots, args.operation, prefix=args.prefix, names=dict(args.names),
+                                state_dir=args.state_dir, root_workers=args.root_workers, report=report, **options)
+        else:
+            if not os.path.isdir(roots[0]) and not is_archive(roots[0]):
+                raise ValueError("Invalid directory: {}".format(roots[0]))
+            report_operation(roots[0], args.operation, report, prefix=args.prefix, names=dict(args.names),
+                             **options)
+            summary = report.summary(args.operation, metrics)
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+        else:
+            stream.flush()
+    if args.metrics_json:
+        metrics.dump_json(args.metrics_json)
+    if args.json:
+        print(json.dumps(summary, indent=2), file=summary_file)
     else:
-        log_lines = ["[{date}], [{time}], iniconfig created logfile\n".format(
-            date=date_str, time=time_str)]
-    # Add new message on top
-    log_lines = ["[{date}], [{time}], {message}\n".format(date=date_str, time=time_str, message=message)] + log_lines
-    with open(log_path, 'w') as f:
-        f.writelines(log_lines)
-
-def main():
+        print_summary(summary, summary_file)
+    return 1 if summary['counts'].get('failed') else 0
+
+def print_summary(summary, file=None):
+    counts = ', '.join('{} {}'.format(count, status) for status, count in sorted(summary['counts'].items()))
+    print("{}: {} assets ({}) in {:.2f} s".format(
+        summary['operation'], summary['assets'], counts or 'none', summary['seconds']), file=file)
+    for category, count in sorted(summary['errors'].items(), key=lambda item: -item[1]):
+        print("    {:<30} {}".format(category, count), file=file)
+
+def run_watch_mode(working_directory, args, options):
+    # Print the result of each pass until interrupted
+    try:
+        for result in watch_assets(working_directory, args.interval, args.debounce, **options):
+            if args.metrics_json:
+                with open(args.metrics_json, 'w') as f:
+                    json.dump(result['metrics'], f, indent=2)
+            if args.json:
+                print(json.dumps(result), flush=True)
+            else:
+                print_result(result)
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def print_result(result):
+    if result['operation'] == 'list':
+        for row in result['assets']:
+            print("{:<40} {:<30} {:<30} {}".format(row['path'], row['type'] + ' ' + row['subtype'],
+                                                 row['name'], row['state']))
+        print("list: {} assets".format(len(result['assets'])))
+        return
+    for path in result['success']:
+        print("ok      {}".format(path))
+    for failure in result['failed']:
+        print("failed  {} (Error: {})".format(failure['path'], failure['error']))
+    if 'output' in result:
+        print("written to {}".format(result['output']))
+    for root in result.get('roots', ()):
+        print("{}: {} succeeded, {} failed, {} unchanged".format(
+            root['working_directory'], root['success'], root['failed'], root['skipped']))
+        if 'output' in root:
+            print("written to {}".format(root['output']))
+    if result['operation'] == 'restore':
+        print("restore: {} restored, {} failed, {} without backup".format(
+            len(result['success']), len(result['failed']), len(result['no_backup'])))
+        return
+    print("{}: {} succeeded, {} failed, {} unchanged".format(
+        result['operation'], len(result['success']), len(result['failed']), len(result['skipped'])))
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv:
+        sys.exit(run_batch_mode(argv))
     try:
         while True:
             clear_screen()
@@ -110,53 +723,1679 @@ def create_free_buildings(working_directory):
             print("Invalid choice. Press ENTER to try again.")
             input()
 
-def modify_building_ini_only(working_directory):
-    failed_dirs = []
+class Asset:
+    # An asset folder found by discover_assets. stat is the DirEntry stat of
+    # its building.ini, or None if the folder only holds backups.
+    __slots__ = ('root', 'stat', 'backups')
+
+    def __init__(self, root, stat, backups):
+        self.root = root
+        self.stat = stat
+        self.backups = backups
+
+def iter_assets(working_directory, max_depth=None):
+    # Find asset folders, i.e. folders with a building.ini or a backup of one,
+    # without descending into them. max_depth limits how many folders deep
+    # below the working directory assets are looked for. Folders are walked
+    # in name order and an asset is only yielded once its parent folder was
+    # listed, so renaming it while the walk goes on is safe.
+    pending = [(working_directory, 0)]
+    while pending:
+        path, depth = pending.pop()
+        subdirs = []
+        building_ini = None
+        backups = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name != STATE_DIRNAME:
+                            subdirs.append(entry.path)
+                    elif entry.name == 'building.ini':
+                        building_ini = entry
+                    elif BACKUP_PATTERN.match(entry.name):
+                        backups.append(entry.name)
+        except OSError:
+            continue
+        if building_ini is not None or backups:
+            stat = building_ini.stat() if building_ini is not None else None
+            yield Asset(path, stat, sorted(backups))
+        elif max_depth is None or depth < max_depth:
+            pending.extend((subdir, depth + 1) for subdir in sorted(subdirs, reverse=True))
+
+def discover_assets(working_directory, max_depth=None):
+    # All assets, sorted and complete before any asset is modified or renamed
+    assets = list(iter_assets(working_directory, max_depth))
+    assets.sort(key=lambda asset: asset.root)
+    return assets
+
+def assets_at(roots):
+    # Assets for the given asset folders; folders without a building.ini are left out
+    for root in roots:
+        try:
+            stat = os.stat(os.path.join(root, 'building.ini'))
+        except OSError:
+            continue
+        yield Asset(root, stat, [])
+
+def metered(metrics, phase, counter, iterable):
+    # Add the time spent producing the items to phase and count them
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            metrics.add_time(phase, time.perf_counter() - start)
+            return
+        metrics.add_time(phase, time.perf_counter() - start)
+        metrics.count(counter)
+        yield item
+
+def prefetch(iterable, size=PIPELINE_DEPTH, batch=32):
+    # Run iterable in a background thread, at most size items ahead of the
+    # consumer, which blocks when it catches up. Items are handed over in
+    # batches to keep the threads from switching for every item. Errors are
+    # raised in the consumer; the thread stops when the consumer does.
+    batches = queue.Queue(max(1, size // batch))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        items = []
+        try:
+            for item in iterable:
+                items.append(item)
+                if len(items) >= batch:
+                    if not put((items, None)):
+                        return
+                    items = []
+            put((items, StopIteration()))
+        except Exception as e:
+            put((items, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            items, error = batches.get()
+            for item in items:
+                yield item
+            if isinstance(error, StopIteration):
+                return
+            if error is not None:
+                raise error
+    finally:
+        stop.set()
+
+def lookup_type_name(type_value, subtype_value):
+    if (type_value, subtype_value) in TYPE_SUBTYPE_NAMES:
+        return TYPE_SUBTYPE_NAMES[(type_value, subtype_value)]
+    elif type_value in TYPE_NAMES:
+        return TYPE_NAMES[type_value]
+    return 'Unknown'
+
+class Directive:
+    # A directive line of a building.ini, with its arguments as bytes
+    __slots__ = ('directive', 'args', 'line', 'position')
+
+    def __init__(self, directive, args, line, position):
+        self.directive = directive
+        self.args = args
+        self.line = line
+        self.position = position
+
+def detect_newline(data):
+    # The first line ending of data, for lines added to it
+    match = NEWLINE_PATTERN.search(data)
+    return match.group() if match else os.linesep.encode('ascii')
+
+def detect_encoding(data):
+    try:
+        data.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return LEGACY_ENCODING
+
+def decode_value(value):
+    # Decode one directive argument, e.g. a name
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode(LEGACY_ENCODING)
+
+def encode_text(text, data, bom=b''):
+    # Encode text to add to data in the encoding data is in. The whole file
+    # is only looked at for text that is not plain ASCII.
+    try:
+        return text.encode('ascii')
+    except UnicodeEncodeError:
+        try:
+            return text.encode('utf-8' if bom else detect_encoding(data))
+        except UnicodeEncodeError:
+            # The file's encoding cannot hold the text; UTF-8 keeps all of it
+            return text.encode('utf-8')
+
+class BuildingIni:
+    # A building.ini split into lines once, as bytes. Lines are written back
+    # byte for byte, so the encoding, a UTF-8 BOM and the line endings are
+    # kept; only arguments that are needed, like the name, are decoded.
+    # directives holds the directive of each line ('' if it is none) and
+    # index the first line of each directive, and of any $TYPE_*/$SUBTYPE_*
+    # under '$TYPE'/'$SUBTYPE'.
+    __slots__ = ('bom', 'data', 'lines', 'directives', 'index')
+
+    def __init__(self, data):
+        self.bom = UTF8_BOM if data.startswith(UTF8_BOM) else b''
+        self.data = data[len(self.bom):] if self.bom else data
+        self.lines = self.data.splitlines(True)
+        self.directives = []
+        self.index = {}
+        for position, line in enumerate(self.lines):
+            if line.startswith(b'$'):
+                # Directives are ASCII; latin-1 decodes any byte
+                directive = line.split(None, 1)[0].decode('latin-1')
+                if directive not in self.index:
+                    self.index[directive] = position
+                if directive.startswith('$TYPE_'):
+                    self.index.setdefault('$TYPE', position)
+                elif directive.startswith('$SUBTYPE_'):
+                    self.index.setdefault('$SUBTYPE', position)
+            else:
+                directive = ''
+            self.directives.append(directive)
+
+    def get(self, directive):
+        position = self.index.get(directive)
+        if position is None:
+            return None
+        line = self.lines[position]
+        parts = line.split(None, 1)
+        return Directive(self.directives[position], parts[1].strip() if len(parts) > 1 else b'', line, position)
+
+    def name_entry(self):
+        # The first $NAME_STR or $NAME line
+        entries = [entry for entry in (self.get('$NAME_STR'), self.get('$NAME')) if entry is not None]
+        return min(entries, key=lambda entry: entry.position) if entries else None
+
+    def asset_name(self):
+        entry = self.name_entry()
+        if entry is None or not entry.args:
+            return 'Unknown'
+        return decode_value(entry.args).strip('"')
+
+    def type_name(self):
+        type_entry = self.get('$TYPE')
+        subtype_entry = self.get('$SUBTYPE')
+        return lookup_type_name(type_entry.directive if type_entry else '',
+                                subtype_entry.directive if subtype_entry else '')
+
+class Rule:
+    # What a profile does to the lines of one directive: remove them, replace
+    # each with other lines, or set their value (in that order of precedence),
+    # and/or insert lines after the first of them. value is the whole line.
+    __slots__ = ('remove', 'replace', 'value', 'insert')
+
+    def __init__(self):
+        self.remove = False
+        self.replace = None
+        self.value = None
+        self.insert = None
+
+class Profile:
+    # A rule set for building.ini, compiled once. A profile is a dict (or
+    # JSON file) with any of:
+    #   remove:       ["$DIRECTIVE", "$PREFIX*", ...]
+    #   replace:      {"$DIRECTIVE": ["new line", ...], ...}
+    #   set:          {"$DIRECTIVE": "value", ...}, added after the name if missing
+    #   insert_after: {"$DIRECTIVE" or "name": ["new line", ...], ...}
+    # Patterns ending in * match by prefix. Every directive gets the rule of
+    # its exact pattern, or else of its longest matching prefix, looked up
+    # once per directive and then cached, so each file is one pass over its
+    # lines. "name" is the $NAME_STR/$NAME line, or the new name at the top.
+    def __init__(self, rules, name='custom'):
+        for key, value in rules.items():
+            if key not in PROFILE_KEYS:
+                raise ValueError("Unknown profile key: {} (expected one of {})".format(key, ', '.join(PROFILE_KEYS)))
+            if not isinstance(value, PROFILE_KEYS[key]):
+                raise ValueError("Profile key {} must be a {}".format(
+                    key, 'list' if PROFILE_KEYS[key] is list else 'mapping'))
+        self.name = name
+        self.rules = rules
+        self.digest = hashlib.sha256(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest()
+        self.exact = {}
+        self.prefixes = []
+        self.name_insert = []
+        self.set_lines = []
+        for pattern in rules.get('remove', []):
+            self.rule(pattern).remove = True
+        for pattern, lines in rules.get('replace', {}).items():
+            self.rule(pattern).replace = self.lines(lines)
+        for pattern, value in rules.get('set', {}).items():
+            if pattern.endswith('*'):
+                raise ValueError("set needs a full directive: {}".format(pattern))
+            if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+                raise ValueError("set needs a text or number value: {} {!r}".format(pattern, value))
+            line = '{} {}'.format(pattern, value) if str(value) else pattern
+            self.rule(pattern).value = line
+            self.set_lines.append((pattern, line))
+        for pattern, lines in rules.get('insert_after', {}).items():
+            if pattern == 'name':
+                self.name_insert = self.lines(lines)
+            else:
+                self.rule(pattern).insert = self.lines(lines)
+        self.prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+        self.cache = {}
+
+    @staticmethod
+    def lines(lines):
+        if isinstance(lines, str) or not all(isinstance(line, str) for line in lines):
+            raise ValueError("Expected a list of lines: {!r}".format(lines))
+        return [line.rstrip('\r\n') for line in lines]
+
+    def rule(self, pattern):
+        if not isinstance(pattern, str) or not pattern.startswith('$'):
+            raise ValueError("Directives start with $: {!r}".format(pattern))
+        if pattern.endswith('*'):
+            for prefix, rule in self.prefixes:
+                if prefix == pattern[:-1]:
+                    return rule
+            rule = Rule()
+            self.prefixes.append((pattern[:-1], rule))
+            return rule
+        return self.exact.setdefault(pattern, Rule())
+
+    def lookup(self, directive):
+        try:
+            return self.cache[directive]
+        except KeyError:
+            pass
+        rule = self.exact.get(directive)
+        if rule is None:
+            for prefix, prefix_rule in self.prefixes:
+                if directive.startswith(prefix):
+                    rule = prefix_rule
+                    break
+        self.cache[directive] = rule
+        return rule
+
+    def apply(self, ini, new_name=None):
+        # The converted building.ini as bytes. Without a new name the name
+        # line is kept and the name lines go right after it; otherwise the
+        # new $NAME_STR replaces it at the top.
+        newline = detect_newline(ini.lines[0] if ini.lines else b'')
+
+        def encode(lines):
+            return b''.join(encode_text(line, ini.data, ini.bom) + newline for line in lines)
+
+        name_entry = ini.name_entry() if new_name is None else None
+        name_position = name_entry.position if name_entry is not None else None
+        set_seen = set()
+        inserted = set()
+        out = [ini.bom]
+        if new_name is not None:
+            out.append(encode(['$NAME_STR "{}"'.format(new_name)]))
+        if name_entry is None:
+            name_index = len(out)
+            out.append(b'')
+        lines = ini.lines
+        cache = self.cache
+        for position, directive in enumerate(ini.directives):
+            rule = None
+            if directive:
+                if new_name is not None and directive in NAME_DIRECTIVES:
+                    continue
+                rule = cache[directive] if directive in cache else self.lookup(directive)
+            if rule is None:
+                out.append(lines[position])
+            elif rule.remove:
+                pass
+            elif rule.replace is not None:
+                out.append(encode(rule.replace))
+            elif rule.value is not None:
+                set_seen.add(directive)
+                line = lines[position]
+                ending = line[len(line.rstrip(b'\r\n')):] or newline
+                out.append(encode_text(rule.value, ini.data, ini.bom) + ending)
+            else:
+                out.append(lines[position])
+            # out[0] is the BOM; a line is only completed if it was written
+            if rule is not None and rule.insert is not None and directive not in inserted:
+                inserted.add(directive)
+                if len(out) > 1 and out[-1] and not out[-1].endswith((b'\n', b'\r')):
+                    out[-1] += newline
+                out.append(encode(rule.insert))
+            if position == name_position:
+                if len(out) > 1 and out[-1] and not out[-1].endswith((b'\n', b'\r')):
+                    out[-1] += newline
+                name_index = len(out)
+                out.append(b'')
+        # Lines after the name: the name inserts and values to set that the
+        # file did not have
+        out[name_index] = encode(self.name_insert + [
+            line for directive, line in self.set_lines if directive not in set_seen])
+        return b''.join(out)
+
+FREE = Profile(FREE_PROFILE, 'free')
+
+def load_profile(path):
+    # A Profile from a JSON file, or the built-in free profile for 'free'
+    if path is None or path == 'free':
+        return FREE
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            rules = json.load(f)
+    except OSError as e:
+        raise ValueError("Cannot read profile {}: {}".format(path, e))
+    except ValueError as e:
+        raise ValueError("Invalid profile {}: {}".format(path, e))
+    if not isinstance(rules, dict):
+        raise ValueError("Invalid profile {}: expected a JSON object".format(path))
+    return Profile(rules, os.path.splitext(os.path.basename(path))[0])
+
+def relative_path(working_directory, path):
+    # os.path.relpath without its getcwd and abspath calls for the paths
+    # discovery builds by joining onto the working directory
+    prefix = os.path.join(working_directory, '')
+    if path.startswith(prefix):
+        return path[len(prefix):]
+    return os.path.relpath(path, working_directory)
+
+def relative_key(working_directory, path):
+    return relative_path(working_directory, path).replace(os.sep, '/')
+
+def state_folder(working_directory, state_dir=None):
+    return state_dir or os.path.join(working_directory, STATE_DIRNAME)
+
+def state_key(base, path):
+    # Key of a path in the state files: relative to base, or the path itself
+    # when base is None, i.e. in a state folder shared by several roots
+    if base is None:
+        return path.replace(os.sep, '/')
+    return relative_key(base, path)
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class Metrics:
+    # Wall-clock time per phase, counters and the slowest assets of a run.
+    # The per-asset phases (read, backup, transform, write, restore) are
+    # summed over all assets, so with several workers they can add up to
+    # more than the run took. Hooks are objects with any of the methods
+    # on_phase(name, seconds), on_count(name, value) and
+    # on_asset(path, seconds, timings), called as values are recorded.
+    def __init__(self, slow_asset_seconds=1.0, slow_asset_limit=100, hooks=()):
+        self.slow_asset_seconds = slow_asset_seconds
+        self.slow_asset_limit = slow_asset_limit
+        self.hooks = list(hooks)
+        self.phases = {}
+        self.counters = {}
+        self.slow_assets = []
+        self.lock = threading.Lock()
+
+    def call_hooks(self, method_name, *args):
+        for hook in self.hooks:
+            method = getattr(hook, method_name, None)
+            if method is not None:
+                method(*args)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+        self.call_hooks('on_phase', name, seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.call_hooks('on_count', name, value)
+
+    def asset(self, path, timings):
+        seconds = sum(timings.values())
+        with self.lock:
+            for name, phase_seconds in timings.items():
+                self.phases[name] = self.phases.get(name, 0.0) + phase_seconds
+            if seconds >= self.slow_asset_seconds:
+                # Keep only the slowest assets
+                heapq.heappush(self.slow_assets, (seconds, path, timings))
+                if len(self.slow_assets) > self.slow_asset_limit:
+                    heapq.heappop(self.slow_assets)
+        self.call_hooks('on_asset', path, seconds, timings)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'phases': dict(self.phases),
+                'counters': dict(self.counters),
+                'slow_assets': [{'path': path, 'seconds': seconds, 'phases': timings}
+                                for seconds, path, timings in sorted(self.slow_assets, reverse=True)],
+            }
+
+    def dump_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+def load_hook(spec):
+    # MODULE:NAME of a hook object, or of a class that is instantiated
+    module_name, sep, attribute = spec.partition(':')
+    if not sep:
+        raise ValueError("Invalid hook, expected MODULE:NAME: {}".format(spec))
+    hook = getattr(importlib.import_module(module_name), attribute)
+    return hook() if isinstance(hook, type) else hook
+
+DURABILITY_MODES = ('none', 'run', 'file')
+
+def fsync_directory(path):
+    # Directories cannot be opened for fsync on Windows
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_file(path, data, current=None, fsync=False):
+    # Write data to a temporary file next to path and move it into place, so
+    # an interrupted run never leaves a truncated file. Nothing is written if
+    # the file already holds data. Returns whether the file was written.
+    if current is None:
+        try:
+            with open(path, 'rb') as f:
+                current = f.read()
+        except OSError:
+            current = None
+    if current == data:
+        return False
+    temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        if current is not None:
+            # The new file keeps the permissions of the one it replaces
+            try:
+                shutil.copymode(path, temp_path)
+            except OSError:
+                pass
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if fsync:
+        fsync_directory(os.path.dirname(path) or '.')
+    return True
+
+class FileWriter:
+    # Writes files with write_file. durability decides when they are synced
+    # to disk: 'none' leaves it to the OS, 'file' syncs every file and its
+    # folder as it is written, and 'run' syncs all files written during the
+    # run, and each of their folders once, when commit() is called.
+    def __init__(self, durability='none'):
+        if durability not in DURABILITY_MODES:
+            raise ValueError("Unknown durability: {}".format(durability))
+        self.durability = durability
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    @property
+    def fsync(self):
+        return self.durability == 'file'
+
+    def write(self, path, data, current=None):
+        written = write_file(path, data, current, self.fsync)
+        if written:
+            self.written(path)
+        return written
+
+    def written(self, path):
+        # Register a file written elsewhere, e.g. by a worker process
+        if self.durability == 'run':
+            with self.lock:
+                self.pending.add(path)
+
+    def commit(self):
+        with self.lock:
+            paths = sorted(self.pending)
+            self.pending = set()
+        directories = set()
+        for path in paths:
+            try:
+                # Windows can only flush a file opened for writing
+                fd = os.open(path, os.O_RDWR if os.name == 'nt' else os.O_RDONLY)
+            except OSError:
+                # Moved by a folder rename after it was written, or read-only
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            directories.add(os.path.dirname(path) or '.')
+        for directory in sorted(directories):
+            fsync_directory(directory)
+
+def transform_signature(operation, prefix='', profile=None):
+    return '{}:{}:{}:{}'.format(TRANSFORM_VERSION, operation, prefix, (profile or FREE).digest[:16])
+
+class Manifest:
+    # Size, mtime and content hash of every building.ini written by a previous
+    # run, keyed by path relative to the working directory (absolute path in
+    # a shared state_dir). An asset whose building.ini still matches its
+    # entry was converted the same way before and is skipped without opening it.
+    def __init__(self, working_directory, state_dir=None):
+        self.base = working_directory if state_dir is None else None
+        self.path = os.path.join(state_folder(working_directory, state_dir), 'manifest.json')
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == TRANSFORM_VERSION:
+                self.entries = data.get('assets', {})
+
+    def key(self, root):
+        return state_key(self.base, os.path.join(root, 'building.ini'))
+
+    def is_current(self, root, transform, stat=None):
+        entry = self.entries.get(self.key(root))
+        if entry is None or entry['transform'] != transform:
+            return False
+        building_ini_path = os.path.join(root, 'building.ini')
+        if stat is None:
+            stat = os.stat(building_ini_path)
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns == entry['mtime_ns']:
+            return True
+        # Touched but possibly unchanged, e.g. by Steam verifying the files
+        if file_sha256(building_ini_path) != entry['sha256']:
+            return False
+        entry['mtime_ns'] = stat.st_mtime_ns
+        return True
+
+    def record(self, root, transform, sha256, previous_root=None):
+        if previous_root is not None:
+            self.entries.pop(self.key(previous_root), None)
+        stat = os.stat(os.path.join(root, 'building.ini'))
+        self.entries[self.key(root)] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': sha256,
+            'transform': transform,
+        }
+
+    def save(self, writer):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = json.dumps({'version': TRANSFORM_VERSION, 'assets': self.entries}).encode('utf-8')
+        writer.write(self.path, data)
+
+def store_object(objects_dir, data, fsync=False):
+    # Store data under its sha256 unless an identical copy is already there.
+    # Returns the hash and whether the data was stored.
+    sha256 = hashlib.sha256(data).hexdigest()
+    object_path = os.path.join(objects_dir, sha256[:2], sha256)
+    if os.path.exists(object_path):
+        return sha256, False
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    write_file(object_path, data, fsync=fsync)
+    return sha256, True
+
+def append_line(path, line, fsync=False):
+    # Append one line to a run's index or journal from a worker. The file is
+    # opened in append mode for each line, so workers in other processes
+    # can add to it as well.
+    try:
+        f = open(path, 'a', encoding='utf-8')
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, 'a', encoding='utf-8')
+    with f:
+        f.write(line)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+class BackupStore:
+    # Original building.ini files, stored once per distinct content in
+    # .iniconfig/objects. Each run appends to an index in
+    # .iniconfig/runs/RUN_ID.jsonl that maps asset paths, relative to the
+    # working directory (absolute paths in a shared state_dir), to their
+    # backup. A line is written as soon as a backup is stored, so a run that
+    # is killed still leaves its backups restorable. Runs of older versions
+    # wrote the whole index at the end, as RUN_ID.json.
+    def __init__(self, working_directory, state_dir=None, fsync=False):
+        self.base = working_directory if state_dir is None else None
+        folder = state_folder(working_directory, state_dir)
+        self.objects_dir = os.path.join(folder, 'objects')
+        self.runs_dir = os.path.join(folder, 'runs')
+        self.run_id = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.fsync = fsync
+        self.file = None
+        self.lock = threading.Lock()
+        self.backups = None
+
+    def key(self, root):
+        return state_key(self.base, root)
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def exists(self, run_id):
+        return any(os.path.exists(os.path.join(self.runs_dir, run_id + extension))
+                   for extension in ('.jsonl', '.json'))
+
+    def run_path(self):
+        return os.path.join(self.runs_dir, self.run_id + '.jsonl')
+
+    @staticmethod
+    def index_line(key, sha256):
+        return json.dumps({'path': key, 'sha256': sha256}) + '\n'
+
+    def record(self, root, sha256):
+        # A later line for the same path, e.g. after a rename, replaces it
+        line = self.index_line(self.key(root), sha256)
+        with self.lock:
+            if self.file is None:
+                os.makedirs(self.runs_dir, exist_ok=True)
+                self.file = open(self.run_path(), 'a', encoding='utf-8')
+            self.file.write(line)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def close(self, fsync=False):
+        with self.lock:
+            if self.file is None:
+                return
+            if fsync:
+                os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+    def run_ids(self):
+        if not os.path.isdir(self.runs_dir):
+            return []
+        run_ids = set()
+        for name in os.listdir(self.runs_dir):
+            if name.endswith('.jsonl'):
+                run_ids.add(name[:-6])
+            elif name.endswith('.json'):
+                run_ids.add(name[:-5])
+        return sorted(run_ids)
+
+    def load_run(self, run_id):
+        path = os.path.join(self.runs_dir, run_id + '.jsonl')
+        if not os.path.exists(path):
+            with open(os.path.join(self.runs_dir, run_id + '.json'), 'r') as f:
+                return json.load(f)['assets']
+        assets = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                # A line cut short by an interrupted run is ignored
+                if line.endswith('\n'):
+                    entry = json.loads(line)
+                    assets[entry['path']] = entry['sha256']
+        return assets
+
+    def latest(self, root):
+        # The hash of root's newest backup, None if it has none
+        backups = self.backups_by_asset().get(self.key(root))
+        return backups[-1][1] if backups else None
+
+    def backups_by_asset(self):
+        # All stored backups, as {path: [(run_id, sha256)]}. The run indexes
+        # are read once, however many roots share the store.
+        if self.backups is None:
+            backups = {}
+            for run_id in self.run_ids():
+                for key, sha256 in self.load_run(run_id).items():
+                    backups.setdefault(key, []).append((run_id, sha256))
+            self.backups = backups
+        return self.backups
+
+class Journal:
+    # The changes of one run, one JSON line each, in .iniconfig/journal:
+    # file edits with the hashes of the content before (kept in the backup
+    # store; None if the file did not exist) and after, and folder renames.
+    # A rename is written before it is made, so undo can replay the lines in
+    # reverse without looking at anything else. Undone journals are kept
+    # with the extension .undone.
+    def __init__(self, working_directory, state_dir=None):
+        self.base = working_directory if state_dir is None else None
+        self.journal_dir = os.path.join(state_folder(working_directory, state_dir), 'journal')
+        self.run_id = None
+        self.file = None
+        self.lock = threading.Lock()
+        # Entries undone or found undone, as {run_id: set of line numbers}
+        self.settled = {}
+
+    def key(self, path):
+        return state_key(self.base, path)
+
+    def in_scope(self, entry, working_directory):
+        # Whether an entry concerns working_directory; a shared journal
+        # holds the changes of several roots
+        if self.base is not None:
+            return True
+        key = entry.get('edit', entry.get('rename'))
+        return key.startswith(state_key(None, working_directory).rstrip('/') + '/')
+
+    def path(self, key):
+        if self.base is None:
+            return key.replace('/', os.sep)
+        return os.path.join(self.base, key.replace('/', os.sep))
+
+    def exists(self, run_id):
+        return any(os.path.exists(os.path.join(self.journal_dir, run_id + extension))
+                   for extension in ('.jsonl', '.undone'))
+
+    def run_path(self):
+        return os.path.join(self.journal_dir, self.run_id + '.jsonl')
+
+    @staticmethod
+    def edit_line(key, before, after):
+        return json.dumps({'edit': key, 'before': before, 'after': after}) + '\n'
+
+    def write(self, line):
+        with self.lock:
+            if self.file is None:
+                os.makedirs(self.journal_dir, exist_ok=True)
+                self.file = open(self.run_path(), 'a', encoding='utf-8')
+            self.file.write(line)
+            self.file.flush()
+
+    def edit(self, path, before, after):
+        self.write(self.edit_line(self.key(path), before, after))
+
+    def rename(self, path, new_path):
+        self.write(json.dumps({'rename': self.key(path), 'to': self.key(new_path)}) + '\n')
+
+    def close(self, fsync=False):
+        with self.lock:
+            if self.file is None:
+                return
+            if fsync:
+                os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+    def run_ids(self):
+        # Runs that can be undone, oldest first
+        if not os.path.isdir(self.journal_dir):
+            return []
+        return sorted(name[:-6] for name in os.listdir(self.journal_dir) if name.endswith('.jsonl'))
+
+    def load(self, run_id):
+        for extension in ('.jsonl', '.undone'):
+            path = os.path.join(self.journal_dir, run_id + extension)
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    # A line cut short by an interrupted run is ignored
+                    return [json.loads(line) for line in f if line.endswith('\n')]
+        raise ValueError("No journal for run {}".format(run_id))
+
+    def mark_undone(self, run_id):
+        os.replace(os.path.join(self.journal_dir, run_id + '.jsonl'),
+                   os.path.join(self.journal_dir, run_id + '.undone'))
+
+    def settle(self, run_id, line_numbers):
+        with self.lock:
+            self.settled.setdefault(run_id, set()).update(line_numbers)
+
+    def mark_settled(self):
+        # Mark the runs whose every entry was undone, by one or several
+        # roots, so the next undo goes on with the run before
+        with self.lock:
+            settled = self.settled
+            self.settled = {}
+        active = self.run_ids()
+        for run_id, line_numbers in settled.items():
+            if run_id in active and len(line_numbers) == len(self.load(run_id)):
+                self.mark_undone(run_id)
+
+def normalize_type(value):
+    # Accept SHOP, TYPE_SHOP and $TYPE_SHOP
+    value = value.strip().upper().lstrip('$')
+    if not value.startswith('TYPE_'):
+        value = 'TYPE_' + value
+    return '$' + value
+
+def scan_asset(root):
+    # Type, subtype and name of an asset, plus what identifies the file version
+    building_ini_path = os.path.join(root, 'building.ini')
+    stat = os.stat(building_ini_path)
+    with open(building_ini_path, 'rb') as f:
+        data = f.read()
+    ini = BuildingIni(data)
+    type_entry = ini.get('$TYPE')
+    subtype_entry = ini.get('$SUBTYPE')
+    return {
+        'type': type_entry.directive if type_entry else '',
+        'subtype': subtype_entry.directive if subtype_entry else '',
+        'name': ini.asset_name(),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': hashlib.sha256(data).hexdigest(),
+    }
+
+class Catalog:
+    # SQLite index of the assets in the working directory: type, subtype,
+    # name, file version and conversion state ('original', or the transform
+    # signature of the conversion that wrote the current file). A catalog in
+    # a shared state_dir holds the assets of several roots by absolute path
+    # and may be used from their threads at once.
+    def __init__(self, working_directory, state_dir=None):
+        self.base = working_directory if state_dir is None else None
+        self.path = os.path.join(state_folder(working_directory, state_dir), 'catalog.sqlite')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS assets ('
+            'path TEXT PRIMARY KEY, type TEXT, subtype TEXT, name TEXT, '
+            'size INTEGER, mtime_ns INTEGER, sha256 TEXT, state TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS assets_type ON assets (type)')
+
+    def close(self):
+        self.connection.close()
+
+    def key(self, root):
+        return state_key(self.base, root)
+
+    def scope(self, working_directory):
+        # SQL condition, and its parameters, for the assets in working_directory
+        if self.base is not None or working_directory is None:
+            return '1', []
+        key = state_key(None, working_directory).rstrip('/')
+        return '(path = ? OR substr(path, 1, ?) = ?)', [key, len(key) + 1, key + '/']
+
+    def refresh(self, assets, workers=1, executor='thread', working_directory=None, prune=True):
+        # Bring the catalog in line with discovered assets of working_directory.
+        # Only assets whose building.ini changed size or mtime are read again.
+        # With prune, rows of assets that were not found are removed; leave it
+        # off when assets are only some of the folders, e.g. in watch mode.
+        condition, parameters = self.scope(working_directory)
+        with self.lock:
+            rows = {row[0]: row[1:] for row in self.connection.execute(
+                'SELECT path, size, mtime_ns, sha256, state FROM assets WHERE ' + condition, parameters)}
+        found = set()
+        changed = []
+        for asset in assets:
+            if asset.stat is None:
+                continue
+            key = self.key(asset.root)
+            found.add(key)
+            row = rows.get(key)
+            if row is None or row[0] != asset.stat.st_size or row[1] != asset.stat.st_mtime_ns:
+                changed.append((asset.root,))
+        updates = []
+        for task, info, error in map_tasks(scan_asset, changed, workers, executor):
+            if error is not None:
+                continue
+            key = self.key(task[0])
+            row = rows.get(key)
+            # A file that was only touched keeps its conversion state
+            state = row[3] if row is not None and row[2] == info['sha256'] else 'original'
+            updates.append((key, info['type'], info['subtype'], info['name'], info['size'],
+                            info['mtime_ns'], info['sha256'], state))
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?, ?, ?, ?)', updates)
+            if prune:
+                self.connection.executemany('DELETE FROM assets WHERE path = ?',
+                                            [(key,) for key in rows if key not in found])
+        return len(updates)
+
+    def query(self, types=None, state=None, working_directory=None):
+        # Paths of the assets of any of the given types and/or in the given state
+        sql = 'SELECT path, type, subtype, name, state FROM assets'
+        condition, parameters = self.scope(working_directory)
+        conditions = [condition]
+        if types:
+            conditions.append('type IN ({})'.format(', '.join('?' * len(types))))
+            parameters.extend(normalize_type(value) for value in types)
+        if state:
+            conditions.append('state = ?')
+            parameters.append(state)
+        sql += ' WHERE ' + ' AND '.join(conditions)
+        with self.lock:
+            return [dict(zip(('path', 'type', 'subtype', 'name', 'state'), row))
+                    for row in self.connection.execute(sql + ' ORDER BY path', parameters)]
+
+    def record(self, previous_root, root, state):
+        # Update an asset after it was converted, renamed or restored
+        info = scan_asset(root)
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM assets WHERE path = ?', (self.key(previous_root),))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.key(root), info['type'], info['subtype'], info['name'],
+                 info['size'], info['mtime_ns'], info['sha256'], state))
+
+def select_assets(working_directory, assets, types, catalog, workers=1, executor='thread', prune=True):
+    # Refresh the catalog and keep only the assets of the given types
+    catalog.refresh(assets, workers, executor, working_directory, prune)
+    if not types:
+        return assets
+    selected = set(row['path'] for row in catalog.query(types, working_directory=working_directory))
+    return [asset for asset in assets if catalog.key(asset.root) in selected]
+
+class RunState:
+    # What a run loads from and saves to the state folder: manifest, backup
+    # store and catalog, with the writer of the run's files. iter_convert and
+    # iter_restore make their own unless run_roots passes one that all its
+    # roots share and that it saves once they are done.
+    def __init__(self, working_directory, state_dir=None, incremental=False, catalog=False,
+                 durability='none'):
+        self.writer = FileWriter(durability)
+        self.workshop = WorkshopIndex(working_directory, state_dir)
+        self.manifest = Manifest(working_directory, state_dir) if incremental else None
+        self.store = BackupStore(working_directory, state_dir, self.writer.fsync)
+        self.catalog = Catalog(working_directory, state_dir) if catalog else None
+        self.journal = Journal(working_directory, state_dir)
+        # One id for the run's backup index and journal
+        run_id = self.store.run_id
+        counter = 1
+        while self.store.exists(run_id) or self.journal.exists(run_id):
+            counter += 1
+            run_id = '{}-{}'.format(self.store.run_id, counter)
+        self.store.run_id = self.journal.run_id = run_id
+
+    def save(self, metrics):
+        try:
+            with metrics.phase('save state'):
+                self.journal.close(self.writer.durability != 'none')
+                self.store.close(self.writer.durability != 'none')
+                # Workers append to both files themselves
+                self.writer.written(self.journal.run_path())
+                self.writer.written(self.store.run_path())
+                if self.manifest is not None:
+                    self.manifest.save(self.writer)
+                self.workshop.save(self.writer)
+            with metrics.phase('sync'):
+                self.writer.commit()
+        finally:
+            if self.catalog is not None:
+                self.catalog.close()
+
+    def journal_file(self, path, before, after):
+        # Journal an edit of a file that is not a building.ini, keeping its
+        # old content in the backup store
+        before_sha256 = None
+        if before is not None:
+            before_sha256, stored = store_object(self.store.objects_dir, before, self.writer.fsync)
+            self.writer.written(self.store.object_path(before_sha256))
+        self.journal.edit(path, before_sha256, hashlib.sha256(after).hexdigest())
+
+def asset_new_name(ini, operation, prefix='', new_name=None):
+    # The name an operation gives an asset, None to keep its name
+    if operation == 'rename-by-type':
+        if prefix:
+            return '{} - {}'.format(prefix, ini.type_name())
+        return ini.type_name()
+    if operation == 'rename-individually' and not new_name:
+        return ini.type_name()
+    return new_name
+
+def convert_asset(root, operation, prefix='', new_name=None, objects_dir=None, fsync=False, profile=None,
+                  logs=None):
+    # Back up and rewrite the building.ini of one asset folder with profile
+    # (default: the free profile). logs is (index path, asset key, journal
+    # path, building.ini key): the backup is indexed and the edit journalled
+    # there before building.ini is replaced, so an asset converted just
+    # before a run is killed can still be restored and undone. A file that
+    # is already converted is not backed up again, so the newest backup
+    # stays the original. Returns the asset name that was set (None if the
+    # name was left alone), the hashes of the new building.ini and of its
+    # backup (None if there is none), whether they were written, the bytes
+    # read and written and the time each step took.
+    timings = {}
+    start = time.perf_counter()
+    building_ini_path = os.path.join(root, 'building.ini')
+    with open(building_ini_path, 'rb') as f:
+        data = f.read()
+    timings['read'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ini = BuildingIni(data)
+    new_name = asset_new_name(ini, operation, prefix, new_name)
+    new_data = (profile or FREE).apply(ini, new_name)
+    timings['transform'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    backup_sha256, backup_stored = None, False
+    if new_data != data:
+        backup_sha256, backup_stored = store_object(objects_dir, data, fsync)
+    timings['backup'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sha256 = hashlib.sha256(new_data).hexdigest()
+    if logs is not None and new_data != data:
+        index_path, key, journal_path, file_key = logs
+        append_line(index_path, BackupStore.index_line(key, backup_sha256), fsync)
+        append_line(journal_path, Journal.edit_line(file_key, backup_sha256, sha256), fsync)
+    written = write_file(building_ini_path, new_data, data, fsync)
+    timings['write'] = time.perf_counter() - start
+    return {
+        'name': new_name,
+        'sha256': sha256,
+        'backup_sha256': backup_sha256,
+        'backup_stored': backup_stored,
+        'written': written,
+        'bytes_read': len(data),
+        'bytes_written': len(new_data) if written else 0,
+        'timings': timings,
+    }
+
+def map_tasks(function, tasks, workers=1, executor='thread'):
+    # Call function(*task) for each task, on a pool if workers > 1.
+    # Yields (task, result, error) in task order. tasks may be a generator;
+    # it is only read as far as 2 * workers tasks ahead of the results.
+    # A task that is None is passed through as (None, None, None) in its
+    # place, so the caller can hand out records of its own, e.g. of skipped
+    # assets, while the tasks are still being read. executor may also be a
+    # running pool, shared with other calls, which is left running.
+    if workers <= 1:
+        for task in tasks:
+            if task is None:
+                yield None, None, None
+                continue
+            try:
+                yield task, function(*task), None
+            except Exception as e:
+                yield task, None, e
+        return
+    shared = isinstance(executor, concurrent.futures.Executor)
+    if shared:
+        pool = executor
+    elif executor == 'process':
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    pending = collections.deque()
+    try:
+        tasks = iter(tasks)
+        while True:
+            for task in tasks:
+                pending.append((task, pool.submit(function, *task) if task is not None else None))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                return
+            task, future = pending.popleft()
+            if future is None:
+                yield None, None, None
+                continue
+            try:
+                yield task, future.result(), None
+            except Exception as e:
+                yield task, None, e
+    finally:
+        if shared:
+            for task, future in pending:
+                if future is not None:
+                    future.cancel()
+        else:
+            pool.shutdown()
+
+def folder_number(folder_name, attempt=0):
+    # A five-digit number derived from the original folder name
+    digest = hashlib.sha256('{}:{}'.format(folder_name, attempt).encode('utf-8')).digest()
+    return 10000 + int.from_bytes(digest[:4], 'big') % 90000
+
+def plan_folder_names(assets, listdir=os.listdir, path=os.path, keep=None):
+    # New folder paths for (root, asset_name) pairs, planned before any
+    # folder is renamed: the asset name without non-word characters plus
+    # folder_number of the original folder name, so a rerun picks the same
+    # names. Names taken in the parent folder, or planned for another asset,
+    # are never used; each parent folder is listed only once. A folder that
+    # is already named this way keeps its name, and so does keep, the
+    # working directory: renaming it would move the state folder with it.
+    # listdir and path are replaced to plan names of folders inside an archive.
+    taken = {}
+    targets = []
+    for root, asset_name in assets:
+        if keep is not None and path.normpath(root) == path.normpath(keep):
+            targets.append(root)
+            continue
+        parent_folder, folder_name = path.split(root)
+        if parent_folder not in taken:
+            taken[parent_folder] = set(os.path.normcase(name) for name in listdir(parent_folder or '.'))
+        names = taken[parent_folder]
+        base = re.sub(r'\W+', '', asset_name)
+        if re.fullmatch(re.escape(base) + r'\d{5}', folder_name):
+            targets.append(root)
+            continue
+        attempt = 0
+        new_folder_name = '{}{}'.format(base, folder_number(folder_name))
+        while os.path.normcase(new_folder_name) in names:
+            attempt += 1
+            new_folder_name = '{}{}'.format(base, folder_number(folder_name, attempt))
+        names.add(os.path.normcase(new_folder_name))
+        targets.append(path.join(parent_folder, new_folder_name))
+    return targets
+
+class WorkshopConfig:
+    # workshopconfig.ini read once as bytes. Its $OBJECT_BUILDING lines are
+    # reconciled against the asset folders in place, every other line is
+    # kept byte for byte.
+    def __init__(self, working_directory, data=None):
+        # data is the file's content if it was already read, e.g. from an archive
+        self.path = os.path.join(working_directory, 'workshopconfig.ini')
+        if data is None and os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        self.data = data
+        data = data or b''
+        self.bom = UTF8_BOM if data.startswith(UTF8_BOM) else b''
+        self.lines = data[len(self.bom):].splitlines(True)
+        self.newline = detect_newline(data)
+        self.encoding = None
+        self.changed = False
+
+    @staticmethod
+    def building(line):
+        # Folder name of an $OBJECT_BUILDING line, else None
+        if not line.startswith(b'$OBJECT_BUILDING'):
+            return None
+        fields = line.split(None, 1)
+        if fields[0] != b'$OBJECT_BUILDING':
+            return None
+        return decode_value(fields[1].strip()) if len(fields) > 1 else ''
+
+    def buildings(self):
+        return [name for name in map(self.building, self.lines) if name is not None]
+
+    def building_line(self, name):
+        try:
+            encoded = name.encode('ascii')
+        except UnicodeEncodeError:
+            if self.encoding is None:
+                self.encoding = 'utf-8' if self.bom else detect_encoding(self.data or b'')
+            try:
+                encoded = name.encode(self.encoding)
+            except UnicodeEncodeError:
+                # The folder has to be listed even if the file's encoding
+                # cannot hold its name
+                encoded = name.encode('utf-8')
+        return b'$OBJECT_BUILDING ' + encoded + self.newline
+
+    def reconcile(self, dir_names, renamed=None):
+        # List exactly dir_names. Entries of renamed folders are updated where
+        # they stand, stale and duplicate entries are dropped and missing ones
+        # are added after the last listed building (or after $VISIBILITY).
+        renamed = renamed or {}
+        wanted = set(dir_names)
+        listed = set()
+        lines = []
+        insert_index = None
+        visibility_index = None
+        for line in self.lines:
+            name = self.building(line)
+            if name is None:
+                if visibility_index is None and line.startswith(b'$VISIBILITY'):
+                    visibility_index = len(lines) + 1
+                lines.append(line)
+                continue
+            new_name = renamed.get(name, name)
+            if new_name in wanted and new_name not in listed:
+                listed.add(new_name)
+                lines.append(line if new_name == name else self.building_line(new_name))
+                insert_index = len(lines)
+        if insert_index is None:
+            insert_index = visibility_index
+        if insert_index is None:
+            lines.append(b'$VISIBILITY' + self.newline)
+            insert_index = len(lines)
+        lines[insert_index:insert_index] = [self.building_line(name) for name in dir_names if name not in listed]
+        for index, line in enumerate(lines[:-1]):
+            if not line.endswith((b'\n', b'\r')):
+                # The file's last line had no line ending and is no longer last
+                lines[index] = line + self.newline
+        if lines != self.lines:
+            self.lines = lines
+            self.changed = True
+        return self.changed
+
+    def serialize(self):
+        return self.bom + b''.join(self.lines)
+
+    def save(self, writer):
+        # Write only when reconcile changed something
+        if not self.changed:
+            return False
+        self.changed = False
+        return writer.write(self.path, self.serialize(), self.data)
+
+def workshop_details(data):
+    # $ITEM_ID, $ITEM_NAME and $ITEM_DESC of a workshopconfig.ini, '' if missing
+    details = ['', '', '']
+    for line in data.splitlines():
+        if not line.startswith(b'$ITEM_'):
+            continue
+        fields = line.split(None, 1)
+        index = ITEM_DIRECTIVES.get(fields[0])
+        if index is not None and len(fields) > 1:
+            details[index] = decode_value(fields[1].strip()).strip('"')
+    return details
+
+class WorkshopItem:
+    # The Steam workshop item an asset folder belongs to
+    __slots__ = ('item_id', 'title', 'description')
+
+    def __init__(self, item_id, title, description):
+        self.item_id = item_id
+        self.title = title
+        self.description = description
+
+class WorkshopIndex:
+    # Steam workshop details of asset folders, from the workshopconfig.ini
+    # of each item folder ($ITEM_ID, $ITEM_NAME, $ITEM_DESC), cached in
+    # .iniconfig/workshop.json and read again only when its mtime or size
+    # changes. Nothing is fetched from the network. Loaded on the first
+    # lookup.
+    def __init__(self, working_directory, state_dir=None):
+        self.base = working_directory if state_dir is None else None
+        self.path = os.path.join(state_folder(working_directory, state_dir), 'workshop.json')
+        self.loaded = False
+        self.changed = False
+        # {folder key: [mtime_ns, size, item_id, title, description]}
+        self.configs = {}
+        # Items of the folders looked at in this run, by path
+        self.folders = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        cache = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache.get('version') != 1:
+                cache = {}
+        self.configs = cache.get('configs', {})
+        self.loaded = True
+
+    def folder_item(self, folder):
+        # The item whose folder this is, None if it is not an item folder
+        if folder in self.folders:
+            return self.folders[folder]
+        details = None
+        try:
+            stat = os.stat(os.path.join(folder, 'workshopconfig.ini'))
+        except OSError:
+            stat = None
+        if stat is not None:
+            key = state_key(self.base, folder)
+            entry = self.configs.get(key)
+            if entry is None or entry[:2] != [stat.st_mtime_ns, stat.st_size]:
+                with open(os.path.join(folder, 'workshopconfig.ini'), 'rb') as f:
+                    entry = [stat.st_mtime_ns, stat.st_size] + workshop_details(f.read())
+                self.configs[key] = entry
+                self.changed = True
+            details = entry[2:]
+        name = os.path.basename(folder)
+        item = None
+        if details is not None and any(details):
+            item_id = details[0] or (name if name.isdigit() else '')
+            item = WorkshopItem(item_id, details[1], details[2])
+        self.folders[folder] = item
+        return item
+
+    def lookup(self, root):
+        # The item of an asset folder: that of the nearest folder at or
+        # above it that is an item folder, None if there is none. Each
+        # folder is only looked at once per run.
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            folder = root
+            while folder:
+                item = self.folder_item(folder)
+                if item is not None:
+                    return item
+                parent = os.path.dirname(folder)
+                if parent == folder:
+                    break
+                folder = parent
+            return None
+
+    def save(self, writer):
+        if not self.changed:
+            return
+        self.changed = False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = json.dumps({'version': 1, 'configs': self.configs})
+        writer.write(self.path, data.encode('utf-8'))
+
+def ask_asset_names(working_directory, roots, names, interactive, workshop=None):
+    # Yield the rename-individually tasks, prompting for names not passed in.
+    # names may also give the name for all assets of a workshop item by its ID.
+    for root in roots:
+        if root is None:
+            # A skipped asset
+            yield None
+            continue
+        # Names passed in by the caller take precedence over the prompt
+        new_name = names.get(os.path.relpath(root, working_directory), names.get(os.path.basename(root), ''))
+        item = workshop.lookup(root) if workshop is not None else None
+        if not new_name and item is not None and item.item_id:
+            new_name = names.get(item.item_id, '')
+        if not new_name and interactive:
+            try:
+                with open(os.path.join(root, 'building.ini'), 'rb') as f:
+                    ini = BuildingIni(f.read())
+            except Exception:
+                # Converting it reports the same error
+                ini = None
+            if ini is not None:
+                # The item's title, if it is known, else the type name
+                suggested = item.title if item is not None and item.title else ini.type_name()
+                new_name = prompt_asset_name(ini.asset_name(), ini.type_name(), item, suggested) or suggested
+        yield (root, 'rename-individually', '', new_name or None)
+
+def asset_record(path, status, error=None, seconds=None):
+    # One streamed result: status is 'converted', 'failed', 'skipped',
+    # 'restored' or 'no backup'. error may be an exception, whose class is
+    # kept as the category of the error.
+    return {
+        'path': path,
+        'status': status,
+        'error': None if error is None else str(error),
+        'category': type(error).__name__ if isinstance(error, BaseException) else None,
+        'seconds': seconds,
+    }
+
+REPORT_FORMATS = ('jsonl', 'csv')
+REPORT_FIELDS = ('path', 'status', 'error', 'category', 'date', 'seconds')
+LIST_FIELDS = ('path', 'type', 'subtype', 'name', 'state')
+
+class Report:
+    # Writes each asset record to stream as it comes in, as JSON Lines or CSV
+    # with the given fields, and keeps only counts: records by status,
+    # failures by error category and the time since the report was started.
+    # Records may come from several threads.
+    def __init__(self, stream, format='jsonl', fields=REPORT_FIELDS):
+        if format not in REPORT_FORMATS:
+            raise ValueError("Unknown report format: {}".format(format))
+        self.stream = stream
+        self.format = format
+        self.fields = fields
+        self.counts = {}
+        self.errors = {}
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.csv_writer = None
+        if format == 'csv':
+            self.csv_writer = csv.DictWriter(stream, fields, extrasaction='ignore', lineterminator='\n')
+            self.csv_writer.writeheader()
+
+    def add(self, record, working_directory=None):
+        # working_directory is joined to the record's path, for reports that
+        # cover several roots
+        if working_directory is not None:
+            record = dict(record, path=os.path.join(working_directory, record['path']))
+        status = record.get('status', 'listed')
+        with self.lock:
+            if self.csv_writer is not None:
+                self.csv_writer.writerow(record)
+            else:
+                self.stream.write(json.dumps(record) + '\n')
+            self.counts[status] = self.counts.get(status, 0) + 1
+            if status == 'failed':
+                category = record.get('category') or 'other'
+                self.errors[category] = self.errors.get(category, 0) + 1
+
+    def summary(self, operation, metrics=None):
+        with self.lock:
+            summary = {
+                'operation': operation,
+                'assets': sum(self.counts.values()),
+                'counts': dict(self.counts),
+                'errors': dict(self.errors),
+                'seconds': time.perf_counter() - self.start,
+            }
+        if metrics is not None:
+            data = metrics.to_dict()
+            summary['phases'] = data['phases']
+            summary['counters'] = data['counters']
+        return summary
+
+def iter_convert(working_directory, operation, prefix='', names=None, interactive=False,
+                 workers=1, executor='thread', incremental=False, max_depth=None,
+                 durability='none', metrics=None, types=None, catalog=False, profile=None, roots=None,
+                 run_state=None):
+    # Convert all assets, those of the given types or only the asset folders
+    # in roots, as a pipeline: a
+    # thread walks the folders, the incremental check and name prompts feed
+    # the workers that read, back up, transform and write building.ini, and
+    # state updates run here one at a time. Folders are renamed in one batch
+    # once all assets are converted. Yields an asset_record for each asset as
+    # it finishes. workshopconfig.ini and the state files are updated once
+    # the generator is exhausted or closed; the state files of a run_state
+    # passed in are left for its owner to save.
+    if metrics is None:
+        metrics = Metrics()
+    for counter in ('assets found', 'assets skipped', 'assets converted', 'assets failed'):
+        metrics.count(counter, 0)
+    transform = transform_signature(operation, prefix, profile)
+    own_state = run_state is None
+    if own_state:
+        with metrics.phase('load state'):
+            run_state = RunState(working_directory, incremental=incremental, catalog=catalog or bool(types),
+                                 durability=durability)
+    writer = run_state.writer
+    manifest = run_state.manifest
+    store = run_state.store
+    journal = run_state.journal
+    # Workshop details, to name assets
+    workshop = run_state.workshop if operation == 'rename-individually' else None
+    if roots is None:
+        assets = prefetch(metered(metrics, 'discover', 'assets found', iter_assets(working_directory, max_depth)))
+    else:
+        assets = metered(metrics, 'discover', 'assets found', assets_at(roots))
+    asset_catalog = run_state.catalog
+    if asset_catalog is not None:
+        # Selecting by type needs every asset in the catalog first
+        assets = list(assets)
+        with metrics.phase('catalog'):
+            selected = select_assets(working_directory, assets, types, asset_catalog, workers, executor,
+                                     prune=roots is None)
+        metrics.count('assets selected', len(selected))
+        selected = set(asset.root for asset in selected)
+    else:
+        selected = None
+    # Every asset found, to list in workshopconfig.ini
+    dir_names = []
+    skipped = collections.deque()
+
+    def iter_roots():
+        for asset in assets:
+            if asset.stat is None:
+                continue
+            key = relative_key(working_directory, asset.root)
+            if key != '.':
+                # The working directory itself is not one of its folders
+                dir_names.append(key)
+            if selected is not None and asset.root not in selected:
+                continue
+            start = time.perf_counter()
+            current = manifest is not None and manifest.is_current(asset.root, transform, asset.stat)
+            metrics.add_time('incremental check', time.perf_counter() - start)
+            if current:
+                skipped.append(asset_record(relative_path(working_directory, asset.root), 'skipped'))
+                metrics.count('assets skipped')
+                # Handed out by the main loop right away
+                yield None
+            else:
+                yield asset.root
+
+    if operation == 'rename-individually':
+        tasks = ask_asset_names(working_directory, iter_roots(), names or {}, interactive, workshop)
+    else:
+        tasks = ((root, operation, prefix, None) if root is not None else None for root in iter_roots())
+    tasks = (task + (store.objects_dir, writer.fsync, profile,
+                     (store.run_path(), store.key(task[0]), journal.run_path(),
+                      journal.key(os.path.join(task[0], 'building.ini'))))
+             if task is not None else None for task in tasks)
+
+    def record_converted(previous_root, root, result):
+        # Bookkeeping for a converted asset, once its folder has its final name
+        metrics.count('files read')
+        metrics.count('bytes read', result['bytes_read'])
+        if result['backup_stored']:
+            metrics.count('backups stored')
+        if result['written']:
+            metrics.count('files written')
+            metrics.count('bytes written', result['bytes_written'])
+        if result['written']:
+            writer.written(store.object_path(result['backup_sha256']))
+            writer.written(os.path.join(root, 'building.ini'))
+        if manifest is not None:
+            manifest.record(root, transform, result['sha256'], previous_root=previous_root)
+        if asset_catalog is not None:
+            asset_catalog.record(previous_root, root, transform)
+
+    # Converted assets waiting for their folder rename, as (root, result)
+    pending = []
+    # Planned renames, as (root, new root, result)
+    renames = collections.deque()
+    renamed = {}
+
+    def apply_renames():
+        # Plan the folder names of all converted assets, then rename them in
+        # one batch. Yields an asset_record for each.
+        if pending:
+            targets = plan_folder_names([(root, result['name']) for root, result in pending],
+                                        keep=working_directory)
+            renames.extend((root, target, result) for (root, result), target in zip(pending, targets))
+            del pending[:]
+        while renames:
+            previous_root, root, result = renames.popleft()
+            error = None
+            if root != previous_root:
+                start = time.perf_counter()
+                # The backup is indexed under the new name before the rename;
+                # an asset converted before keeps its newest backup
+                backup_sha256 = result['backup_sha256'] or store.latest(previous_root)
+                if backup_sha256 is not None:
+                    store.record(root, backup_sha256)
+                journal.rename(previous_root, root)
+                try:
+                    os.rename(previous_root, root)
+                    renamed[relative_key(working_directory, previous_root)] = relative_key(working_directory, root)
+                except OSError as e:
+                    error = e
+                    root = previous_root
+                metrics.add_time('rename', time.perf_counter() - start)
+            # Recorded under the folder's name either way; building.ini was converted
+            record_converted(previous_root, root, result)
+            if error is None:
+                metrics.count('assets converted')
+                yield asset_record(relative_path(working_directory, root), 'converted',
+                                   seconds=sum(result['timings'].values()))
+            else:
+                metrics.count('assets failed')
+                yield asset_record(relative_path(working_directory, root), 'failed', error)
+
+    complete = False
+    convert_start = time.perf_counter()
+    try:
+        # Tasks are (root, operation, prefix, new_name, objects_dir, fsync, profile, logs)
+        for task, result, error in map_tasks(convert_asset, tasks, workers, executor):
+            while skipped:
+                yield skipped.popleft()
+            if task is None:
+                continue
+            root = task[0]
+            if error is not None:
+                metrics.count('assets failed')
+                yield asset_record(relative_path(working_directory, root), 'failed', error)
+                continue
+            metrics.asset(relative_path(working_directory, root), result['timings'])
+            if operation != 'modify':
+                pending.append((root, result))
+                continue
+            record_converted(root, root, result)
+            metrics.count('assets converted')
+            yield asset_record(relative_path(working_directory, root), 'converted',
+                               seconds=sum(result['timings'].values()))
+        while skipped:
+            yield skipped.popleft()
+        for record in apply_renames():
+            yield record
+        complete = True
+    finally:
+        metrics.add_time('convert', time.perf_counter() - convert_start)
+        try:
+            # Stopped early: the assets converted so far still get their names
+            for record in apply_renames():
+                pass
+            # An asset given as the working directory has no workshopconfig.ini of its own
+            own_asset = os.path.exists(os.path.join(working_directory, 'building.ini'))
+            if operation != 'modify' and (complete or renamed) and not own_asset:
+                with metrics.phase('workshopconfig'):
+                    workshop_config = WorkshopConfig(working_directory)
+                    if complete and roots is None:
+                        # Every asset found is listed, under its new name if it was renamed
+                        listed = [renamed.get(key, key) for key in dir_names]
+                    else:
+                        # Not every asset was seen; follow the renames and add the assets seen
+                        listed = list(dict.fromkeys(
+                            [renamed.get(name, name) for name in workshop_config.buildings()] +
+                            [renamed.get(key, key) for key in dir_names]))
+                    if workshop_config.reconcile(listed, renamed):
+                        run_state.journal_file(workshop_config.path, workshop_config.data,
+                                               workshop_config.serialize())
+                    workshop_config.save(writer)
+        finally:
+            # The backups of this run stay restorable whatever happened above
+            if own_state:
+                run_state.save(metrics)
+
+def convert_free_buildings(working_directory, operation, prefix='', names=None, interactive=False, **options):
+    # Run iter_convert to the end. Returns the relative paths of converted,
+    # failed and skipped assets.
     success_dirs = []
+    failed_dirs = []
+    skipped_dirs = []
+    for record in iter_convert(working_directory, operation, prefix, names, interactive, **options):
+        if record['status'] == 'converted':
+            success_dirs.append(record['path'])
+        elif record['status'] == 'failed':
+            failed_dirs.append((record['path'], record['error']))
+        else:
+            skipped_dirs.append(record['path'])
+    return success_dirs, failed_dirs, skipped_dirs
+
+def modify_building_ini_only(working_directory, interactive=True, metrics=None, **options):
+    if metrics is None:
+        metrics = Metrics()
     log_message = "iniconfig check: Modify building.ini only"
     update_log(log_message)
-    for root, dirs, files in os.walk(working_directory):
-        if 'building.ini' in files:
-            try:
-                building_ini_path = os.path.join(root, 'building.ini')
-                backup_name = 'building.{date}.bak'.format(date=datetime.date.today().strftime("%Y%m%d"))
-                backup_path = os.path.join(root, backup_name)
-                shutil.copy2(building_ini_path, backup_path)
-                with open(building_ini_path, 'r') as f:
-                    lines = f.readlines()
-                # Remove lines starting with the specified keys
-                lines = [line for line in lines if not line.startswith((
-                    '$COST_WORK', '$COST_RESOURCE', '$NO_LIFESPAN', '$HEATING_DISABLE',
-                    '$WATERSEWAGE_DISABLE', '$WASTE_WORKERS_DISABLE', '$WASTE_CUSTOMERS_DISABLE',
-                    '$COUNT_LIMIT', '$ELETRIC_WITHOUT_WORKING_FACTOR',
-                    '$ELETRIC_WITHOUT_LIGHTING_FACTOR', '$NAME_STR', '$NAME'
-                ))]
-                # Find index to insert new lines after $NAME_STR or $NAME
-                insert_index = None
-                for i, line in enumerate(lines):
-                    if line.startswith('$NAME_STR') or line.startswith('$NAME'):
-                        insert_index = i + 1
-                        break
-                if insert_index is None:
-                    insert_index = 0
-                new_lines = lines[:insert_index] + [
-                    '$NO_LIFESPAN\n',
-                    '$HEATING_DISABLE\n',
-                    '$WATERSEWAGE_DISABLE\n',
-                    '$WASTE_WORKERS_DISABLE\n',
-                    '$WASTE_CUSTOMERS_DISABLE\n',
-                    '$COUNT_LIMIT 999\n',
-                    '$ELETRIC_WITHOUT_WORKING_FACTOR 1\n',
-                    '$ELETRIC_WITHOUT_LIGHTING_FACTOR 1\n'
-                ] + lines[insert_index:]
-                with open(building_ini_path, 'w') as f:
-                    f.writelines(new_lines)
-                success_dirs.append(os.path.relpath(root, working_directory))
-            except Exception as e:
-                failed_dirs.append((os.path.relpath(root, working_directory), str(e)))
-    display_report(working_directory, success_dirs, failed_dirs)
+    success_dirs, failed_dirs, skipped_dirs = convert_free_buildings(
+        working_directory, 'modify', interactive=interactive, metrics=metrics, **options)
+    if interactive:
+        display_report(working_directory, success_dirs, failed_dirs, skipped_dirs)
+    return make_result('modify', working_directory, success_dirs, failed_dirs, skipped_dirs, metrics)
 
-def rename_assets_by_type(working_directory):
+def prompt_prefix():
     clear_screen()
     print("-" * 80)
     print("WRSR-INICONFIG | https://github.com/auhrs/wrsr-iniconfig/                       (c) 2024 AUHRS")
@@ -165,389 +2404,645 @@ def rename_assets_by_type(working_directory):
     print("This option sets the asset name according to the building's type or subtype")
     print("(which is declared in the building.ini). E.g., if the script finds  $TYPE_SHOP ")
     print("the name of the asset in game will be set to Shop. Its folder will be renamed")
-    print("ShopNNNNN, where NNNNN is five-digit random number.\n")
+    print("ShopNNNNN, where NNNNN is a five-digit number.\n")
     print("You can also set a prefix so it is easier to search the asset ingame.\n")
     print("Set a prefix or press enter for no prefix:")
-    prefix = input().strip()
+    return input().strip()
+
+def rename_assets_by_type(working_directory, prefix=None, interactive=True, metrics=None, **options):
+    if prefix is None:
+        prefix = prompt_prefix() if interactive else ''
+    if metrics is None:
+        metrics = Metrics()
 
-    failed_dirs = []
-    success_dirs = []
     log_message = "iniconfig check: Renamed asset according to building type"
     update_log(log_message)
-    # Mappings as per your instructions
-    type_subtype_names = {
-        ('$TYPE_UNIVERSITY', '$SUBTYPE_MEDICAL'): 'Medical University',
-        ('$TYPE_UNIVERSITY', '$SUBTYPE_TECHNICAL'): 'Technical University',
-        ('$TYPE_UNIVERSITY', '$SUBTYPE_SOVIET'): 'Party HQ',
-        ('$TYPE_LIVING', '$SUBTYPE_HOSTEL'): 'Hostel',
-        ('$TYPE_BROADCAST', '$SUBTYPE_RADIO'): 'Radio station',
-        ('$TYPE_BROADCAST', '$SUBTYPE_TELEVISION'): 'Television station',
-        ('$TYPE_STORAGE', '$SUBTYPE_SPACE_FOR_VEHICLES'): 'Vehicle storage',
-        ('$TYPE_PRODUCTION_LINE', '$SUBTYPE_ROAD'): 'Vehicle production line',
-        ('$TYPE_PRODUCTION_LINE', '$SUBTYPE_AIRPLANE'): 'Aircraft production line',
-        ('$TYPE_PRODUCTION_LINE', '$SUBTYPE_RAIL'): 'Locomotive/car production line',
-        ('$TYPE_ROADDEPO', '$SUBTYPE_TROLLEYBUS'): 'Trolleybus depot',
-        ('$TYPE_ROADDEPO', '$SUBTYPE_TRAM'): 'Tram depot',
-        ('$TYPE_RAIL_TRAFO', '$SUBTYPE_ROAD'): 'Trolleybus trafo',
-        ('$TYPE_PASSANGER_STATION', '$SUBTYPE_CABLEWAY'): 'Cableway passenger station',
-        ('$TYPE_PASSANGER_STATION', '$SUBTYPE_SHIP'): 'Ferry terminal',
-        ('$TYPE_PASSANGER_STATION', '$SUBTYPE_AIRPLANE'): 'Airport terminal',
-        ('$TYPE_PASSANGER_STATION', '$SUBTYPE_METRO'): 'Metro station',
-        ('$TYPE_CARGO_STATION', '$SUBTYPE_CABLEWAY'): 'Cableway cargo station',
-        ('$TYPE_CARGO_STATION', '$SUBTYPE_AIRPLANE'): 'Airplane cargo station',
-        ('$TYPE_CARGO_STATION', '$SUBTYPE_SHIP'): 'Seaport (experimental)',
-        ('$TYPE_ENGINE', '$SUBTYPE_CABLEWAY'): 'Cableway engine',
-        ('$TYPE_CONSTRUCTION_OFFICE', '$SUBTYPE_AIRPLANE'): 'Helicopter construction office',
-        ('$TYPE_WATER_PUMP', '$SUBTYPE_WATER_SWITCH'): 'Water switch',
-        ('$TYPE_TRANSFORMATOR', '$SUBTYPE_PRIORITY_1'): 'Priority switch',
-        ('$TYPE_WAITING_STATION', '$SUBTYPE_METRO'): 'Metro end station',
-        ('$TYPE_ELETRIC_EXPORT', '$SUBTYPE_OWN_CUSTOM'): 'Custom electric export',
-    }
+    success_dirs, failed_dirs, skipped_dirs = convert_free_buildings(
+        working_directory, 'rename-by-type', prefix=prefix, interactive=interactive, metrics=metrics,
+        **options)
+    if interactive:
+        display_report(working_directory, success_dirs, failed_dirs, skipped_dirs)
+    return make_result('rename-by-type', working_directory, success_dirs, failed_dirs, skipped_dirs, metrics)
 
-    type_names = {
-        '$TYPE_AIRPLANE_GATE': 'Aircraft gate',
-        '$TYPE_AIRPLANE_PARKING': 'Aircraft parking',
-        '$TYPE_AIRPLANE_TOWER': 'Aircraft tower',
-        '$TYPE_ATTRACTION': 'Attraction',
-        '$TYPE_BROADCAST': 'Broadcast',
-        '$TYPE_CAR_DEALER': 'Car dealer',
-        '$TYPE_CARGO_STATION': 'Cargo station',
-        '$TYPE_CHURCH': 'Church',
-        '$TYPE_CITYHALL': 'City hall',
-        '$TYPE_CONSTRUCTION_OFFICE': 'Construction office',
-        '$TYPE_CONSTRUCTION_OFFICE_RAIL': 'Rail construction office',
-        '$TYPE_CONTAINER_FACILITY': 'Container facility',
-        '$TYPE_COOLING_TOWER': 'Cooling tower',
-        '$TYPE_COURT_HOUSE': 'Court house',
-        '$TYPE_CUSTOMHOUSE': 'Custom house',
-        '$TYPE_DEMOLITION_OFFICE': 'Demolition office',
-        '$TYPE_DISTRIBUTION_OFFICE': 'Distribution office',
-        '$TYPE_DISTRIBUTION_OFFICE_RAIL': 'Rail distribution office',
-        '$TYPE_ELETRIC_EXPORT': 'Electric export',
-        '$TYPE_ELETRIC_IMPORT': 'Electric import',
-        '$TYPE_ENGINE': 'Engine',
-        '$TYPE_FACTORY': 'Factory',
-        '$TYPE_FARM': 'Farm',
-        '$TYPE_FIELD': 'Field',
-        '$TYPE_FIRESTATION': 'Fire station',
-        '$TYPE_FOREIGN_PIPELINE_EXPORT': 'Foreign pipeline export',
-        '$TYPE_FORKLIFT_GARAGE': 'Forklift garage',
-        '$TYPE_GARBAGE_OFFICE': 'Garbage office',
-        '$TYPE_GAS_STATION': 'Gas station',
-        '$TYPE_HEATING_ENDSTATION': 'Heating end station',
-        '$TYPE_HEATING_PLANT': 'Heating plant',
-        '$TYPE_HEATING_SWITCH': 'Heating switch',
-        '$TYPE_HOSPITAL': 'Hospital',
-        '$TYPE_HOTEL': 'Hotel',
-        '$TYPE_KINDERGARTEN': 'Kindergarten',
-        '$TYPE_KINO': 'Cinema',
-        '$TYPE_LIVING': 'Residential',
-        '$TYPE_MINE_BAUXITE': 'Bauxite mine',
-        '$TYPE_MINE_COAL': 'Coal mine',
-        '$TYPE_MINE_GRAVEL': 'Gravel mine',
-        '$TYPE_MINE_IRON': 'Iron mine',
-        '$TYPE_MINE_OIL': 'Oil rig/pumpjack',
-        '$TYPE_MINE_URANIUM': 'Uranium mine',
-        '$TYPE_MINE_WATER': 'Water pump',
-        '$TYPE_MINE_WATER_SURFACE': 'Surface water pump',
-        '$TYPE_MINE_WOOD': 'Woodcutter',
-        '$TYPE_MONUMENT': 'Monument',
-        '$TYPE_ORPHANAGE': 'Orphanage',
-        '$TYPE_PARKING': 'Parking',
-        '$TYPE_PASSANGER_STATION': 'Passenger station',
-        '$TYPE_PEDESTRIAN_BRIDGE': 'Pedestrian bridge',
-        '$TYPE_POLICE_STATION': 'Police station',
-        '$TYPE_POLLUTION_METER': 'Pollution meter',
-        '$TYPE_POWERPLANT': 'Power plant',
-        '$TYPE_PRISON': 'Prison',
-        '$TYPE_PRODUCTION_LINE': 'Production line',
-        '$TYPE_PUB': 'Pub',
-        '$TYPE_RAIL_TRAFO': 'Rail transformer',
-        '$TYPE_RAILDEPO': 'Rail depot',
-        '$TYPE_REPAIR_OFFICE': 'Repair office',
-        '$TYPE_ROADDEPO': 'Road depot',
-        '$TYPE_SCHOOL': 'School',
-        '$TYPE_SCRAPYARD': 'Scrapyard',
-        '$TYPE_SECRET_POLICE': 'Secret police',
-        '$TYPE_SEWAGE_DISCHARGE': 'Sewage discharge',
-        '$TYPE_SEWAGE_ENDSTATION': 'Sewage reservoir',
-        '$TYPE_SEWAGE_PUMP': 'Sewage pump',
-        '$TYPE_SEWAGE_TREATMENT': 'Sewage treatment',
-        '$TYPE_SHIP_DOCK': 'Ship dock',
-        '$TYPE_SHOP': 'Shop',
-        '$TYPE_SPORT': 'Sport',
-        '$TYPE_STORAGE': 'Storage',
-        '$TYPE_SUBSTATION': 'Substation',
-        '$TYPE_TRAM_GATE': 'Tram gate',
-        '$TYPE_TRANSFORMATOR': 'Transformer',
-        '$TYPE_TRASH_CONTAINER': 'Trash container',
-        '$TYPE_UNIVERSITY': 'University',
-        '$TYPE_WAITING_STATION': 'Waiting station',
-        '$TYPE_WATER_ENDSTATION': 'Water reservoir',
-        '$TYPE_WATER_PUMP': 'Water pump',
-        '$TYPE_WATER_SWITCH': 'Water switch',
-        '$TYPE_WATER_TREATMENT': 'Water treatment',
-    }
+def rename_assets_individually(working_directory, names=None, interactive=True, metrics=None, **options):
+    if metrics is None:
+        metrics = Metrics()
+    log_message = "iniconfig check: Renamed asset individually"
+    update_log(log_message)
+    success_dirs, failed_dirs, skipped_dirs = convert_free_buildings(
+        working_directory, 'rename-individually', names=names, interactive=interactive, metrics=metrics,
+        **options)
+    if interactive:
+        display_report(working_directory, success_dirs, failed_dirs, skipped_dirs)
+    return make_result('rename-individually', working_directory, success_dirs, failed_dirs, skipped_dirs,
+                       metrics)
 
-    workshopconfig_path = os.path.join(working_directory, 'workshopconfig.ini')
+def prompt_asset_name(asset_found, type_or_subtype_name, item=None, suggested=None):
+    # item is the WorkshopItem of the asset, if it is known
+    clear_screen()
+    print("-" * 80)
+    print("WRSR-INICONFIG | https://github.com/auhrs/wrsr-iniconfig/         (c) 2024 AUHRS")
+    print("-" * 80)
+    print("\nRENAME EACH ASSET INDIVIDUALLY")
+    print("Asset found:   {}".format(asset_found))
+    print("Type of asset: {}".format(type_or_subtype_name))
+    print("Asset ID:      {}{}".format(WORKSHOP_URL, item.item_id if item is not None else ''))
+    print("\nItem:          {}".format(item.title if item is not None else ''))
+    if item is not None and item.description:
+        print("               {}".format(item.description.splitlines()[0][:64]))
+    print("\nType in the asset's new name below and press ENTER to continue.\n")
+    print("Press CTRL+C to cancel all operations")
+    print("-" * 80)
+    return input("Enter new asset name (suggested: {}): ".format(suggested or type_or_subtype_name)).strip()
 
-    # Remove lines starting with $OBJECT_BUILDING
-    if os.path.exists(workshopconfig_path):
-        with open(workshopconfig_path, 'r') as f:
-            workshop_lines = f.readlines()
-        workshop_lines = [line for line in workshop_lines if not line.startswith('$OBJECT_BUILDING')]
-    else:
-        workshop_lines = []
+class Backup:
+    # One backup of an asset's building.ini: a stored object of a run, or a
+    # building.YYYYMMDD.bak file written by an older version (run_id '').
+    __slots__ = ('date', 'run_id', 'path', 'label')
 
-    for root, dirs, files in os.walk(working_directory):
-        if 'building.ini' in files:
-            try:
-                building_ini_path = os.path.join(root, 'building.ini')
-                backup_name = 'building.{date}.bak'.format(date=datetime.date.today().strftime("%Y%m%d"))
-                backup_path = os.path.join(root, backup_name)
-                shutil.copy2(building_ini_path, backup_path)
-
-                with open(building_ini_path, 'r') as f:
-                    lines = f.readlines()
-
-                # Remove specified lines
-                lines = [line for line in lines if not line.startswith((
-                    '$COST_WORK', '$COST_RESOURCE', '$NO_LIFESPAN', '$HEATING_DISABLE',
-                    '$WATERSEWAGE_DISABLE', '$WASTE_WORKERS_DISABLE', '$WASTE_CUSTOMERS_DISABLE',
-                    '$COUNT_LIMIT', '$ELETRIC_WITHOUT_WORKING_FACTOR',
-                    '$ELETRIC_WITHOUT_LIGHTING_FACTOR', '$NAME_STR', '$NAME'
-                ))]
-
-                # Extract $TYPE and $SUBTYPE
-                type_line = next((line for line in lines if line.startswith('$TYPE')), '').strip()
-                subtype_line = next((line for line in lines if line.startswith('$SUBTYPE')), '').strip()
-
-                type_value = type_line.split(' ')[0] if type_line else ''
-                subtype_value = subtype_line.split(' ')[0] if subtype_line else ''
-
-                if (type_value, subtype_value) in type_subtype_names:
-                    type_or_subtype_name = type_subtype_names[(type_value, subtype_value)]
-                elif type_value in type_names:
-                    type_or_subtype_name = type_names[type_value]
-                else:
-                    type_or_subtype_name = 'Unknown'
+    def __init__(self, date, run_id, path, label):
+        self.date = date
+        self.run_id = run_id
+        self.path = path
+        self.label = label
 
-                # Construct $NAME_STR
-                if prefix:
-                    asset_name = '{} - {}'.format(prefix, type_or_subtype_name)
-                else:
-                    asset_name = type_or_subtype_name
-
-                # Prepare new building.ini
-                new_lines = ['$NAME_STR "{}"\n'.format(asset_name)]
-                new_lines += [
-                    '$NO_LIFESPAN\n',
-                    '$HEATING_DISABLE\n',
-                    '$WATERSEWAGE_DISABLE\n',
-                    '$WASTE_WORKERS_DISABLE\n',
-                    '$WASTE_CUSTOMERS_DISABLE\n',
-                    '$COUNT_LIMIT 999\n',
-                    '$ELETRIC_WITHOUT_WORKING_FACTOR 1\n',
-                    '$ELETRIC_WITHOUT_LIGHTING_FACTOR 1\n'
-                ] + lines
-
-                with open(building_ini_path, 'w') as f:
-                    f.writelines(new_lines)
-
-                # Rename folder
-                random_number = str(random.randint(10000, 99999))
-                folder_name = '{}{}'.format(asset_name, random_number)
-                folder_name = re.sub(r'\W+', '', folder_name)
-                parent_folder = os.path.dirname(root)
-                new_folder_path = os.path.join(parent_folder, folder_name)
-                os.rename(root, new_folder_path)
-
-                success_dirs.append(os.path.relpath(new_folder_path, working_directory))
-            except Exception as e:
-                failed_dirs.append((os.path.relpath(root, working_directory), str(e)))
-
-    # Update workshopconfig.ini
-    # Remove lines starting with $OBJECT_BUILDING
-    if os.path.exists(workshopconfig_path):
-        with open(workshopconfig_path, 'r') as f:
-            workshop_lines = f.readlines()
-        workshop_lines = [line for line in workshop_lines if not line.startswith('$OBJECT_BUILDING')]
-    else:
-        workshop_lines = []
+def index_backups(working_directory, assets, store):
+    # Every backup of every asset, oldest first, as (asset, backups)
+    stored = store.backups_by_asset()
+    for asset in assets:
+        backups = [Backup(name.split('.')[1], '', os.path.join(asset.root, name), name)
+                   for name in asset.backups]
+        for run_id, sha256 in stored.get(store.key(asset.root), ()):
+            backups.append(Backup(run_id[:8], run_id, store.object_path(sha256),
+                                  "{} of run {}".format(sha256[:12], run_id)))
+        backups.sort(key=lambda backup: (backup.date, backup.run_id))
+        yield asset, backups
 
-    # Find index after $VISIBILITY
-    visibility_index = None
-    for i, line in enumerate(workshop_lines):
-        if line.startswith('$VISIBILITY'):
-            visibility_index = i + 1
-            break
-    if visibility_index is None:
-        workshop_lines.append('$VISIBILITY\n')
-        visibility_index = len(workshop_lines)
+def select_backup(backups, date=None, run_id=None):
+    # The newest backup, or the newest of the given date or run
+    if run_id:
+        backups = [backup for backup in backups if backup.run_id == run_id]
+    if date:
+        backups = [backup for backup in backups if backup.date == date.replace('-', '')]
+    return backups[-1] if backups else None
 
-    # Add $OBJECT_BUILDING lines
-    for dir_name in os.listdir(working_directory):
-        dir_path = os.path.join(working_directory, dir_name)
-        if os.path.isdir(dir_path):
-            workshop_lines.insert(visibility_index, '$OBJECT_BUILDING {}\n'.format(dir_name))
-            visibility_index += 1
+def restore_asset(root, backup_path, fsync=False, objects_dir=None, logs=None):
+    # Replace building.ini with the backup in one step, after storing the
+    # file it replaces in objects_dir and journalling the edit in logs
+    # (journal path, building.ini key) so the restore can be undone. Returns
+    # whether it was written, i.e. differed from the backup, the hashes of
+    # the replaced and the restored file, the bytes written and the time
+    # each step took.
+    start = time.perf_counter()
+    building_ini_path = os.path.join(root, 'building.ini')
+    with open(backup_path, 'rb') as f:
+        data = f.read()
+    try:
+        with open(building_ini_path, 'rb') as f:
+            current = f.read()
+    except FileNotFoundError:
+        current = None
+    read_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    previous_sha256 = None
+    if objects_dir is not None and current is not None and current != data:
+        # Kept before building.ini is replaced
+        previous_sha256, stored = store_object(objects_dir, current, fsync)
+    sha256 = hashlib.sha256(data).hexdigest()
+    if logs is not None and current != data:
+        journal_path, file_key = logs
+        append_line(journal_path, Journal.edit_line(file_key, previous_sha256, sha256), fsync)
+    written = write_file(building_ini_path, data, current, fsync=fsync)
+    return {
+        'written': written,
+        'sha256': sha256 if written else None,
+        'previous_sha256': previous_sha256,
+        'bytes_written': len(data) if written else 0,
+        'timings': {'read': read_seconds, 'restore': time.perf_counter() - start},
+    }
 
-    with open(workshopconfig_path, 'w') as f:
-        f.writelines(workshop_lines)
+def iter_restore(working_directory, date=None, run_id=None, workers=1, executor='thread', max_depth=None,
+                 durability='none', metrics=None, types=None, catalog=False, run_state=None):
+    # Restore one backup per asset as the folders are walked. Yields an
+    # asset_record for each asset, with the date of the restored backup.
+    if metrics is None:
+        metrics = Metrics()
+    for counter in ('assets found', 'assets restored', 'assets failed', 'assets without backup'):
+        metrics.count(counter, 0)
+    own_state = run_state is None
+    if own_state:
+        run_state = RunState(working_directory, catalog=catalog or bool(types), durability=durability)
+    store = run_state.store
+    writer = run_state.writer
+    journal = run_state.journal
+    assets = prefetch(metered(metrics, 'discover', 'assets found', iter_assets(working_directory, max_depth)))
+    asset_catalog = run_state.catalog
+    if asset_catalog is not None:
+        with metrics.phase('catalog'):
+            assets = select_assets(working_directory, list(assets), types, asset_catalog, workers, executor)
+        metrics.count('assets selected', len(assets))
+    no_backup = collections.deque()
+    selected = {}
 
-    display_report(working_directory, success_dirs, failed_dirs)
+    def iter_tasks():
+        for asset, backups in index_backups(working_directory, assets, store):
+            backup = select_backup(backups, date, run_id)
+            if backup is None:
+                message = "No backup file found" if not backups else "No backup file of the selected date or run"
+                no_backup.append(asset_record(relative_path(working_directory, asset.root), 'no backup', message))
+                metrics.count('assets without backup')
+                yield None
+                continue
+            selected[asset.root] = backup
+            yield (asset.root, backup.path, writer.fsync, store.objects_dir,
+                   (journal.run_path(), journal.key(os.path.join(asset.root, 'building.ini'))))
+
+    restore_start = time.perf_counter()
+    try:
+        for task, result, error in map_tasks(restore_asset, iter_tasks(), workers, executor):
+            while no_backup:
+                yield no_backup.popleft()
+            if task is None:
+                continue
+            root = task[0]
+            backup = selected.pop(root)
+            if error is None:
+                metrics.asset(relative_path(working_directory, root), result['timings'])
+                metrics.count('assets restored')
+                if result['written']:
+                    metrics.count('files written')
+                    metrics.count('bytes written', result['bytes_written'])
+                    writer.written(os.path.join(root, 'building.ini'))
+                    if result['previous_sha256'] is not None:
+                        writer.written(store.object_path(result['previous_sha256']))
+                if asset_catalog is not None:
+                    asset_catalog.record(root, root, 'restored')
+                update_log("Restored backup {} as building.ini".format(backup.label))
+                record = asset_record(relative_path(working_directory, root), 'restored',
+                                      seconds=sum(result['timings'].values()))
+                record['date'] = datetime.datetime.strptime(backup.date, '%Y%m%d').strftime('%Y-%m-%d')
+                yield record
+            else:
+                metrics.count('assets failed')
+                yield asset_record(relative_path(working_directory, root), 'failed', error)
+        while no_backup:
+            yield no_backup.popleft()
+    finally:
+        metrics.add_time('restore all', time.perf_counter() - restore_start)
+        if own_state:
+            run_state.save(metrics)
 
-def rename_assets_individually(working_directory):
+def restore_backups(working_directory, interactive=True, metrics=None, **options):
+    restored_files = []
     failed_dirs = []
-    success_dirs = []
-    log_message = "iniconfig check: Renamed asset individually"
+    no_backup_dirs = []
+    log_message = "iniconfig check: Restored backups"
     update_log(log_message)
+    if metrics is None:
+        metrics = Metrics()
+    for record in iter_restore(working_directory, metrics=metrics, **options):
+        if record['status'] == 'restored':
+            restored_files.append((record['date'], record['path']))
+        elif record['status'] == 'failed':
+            failed_dirs.append((record['path'], record['error']))
+        else:
+            no_backup_dirs.append((record['path'], record['error']))
 
-    workshopconfig_path = os.path.join(working_directory, 'workshopconfig.ini')
+    if interactive:
+        display_restore_report(working_directory, restored_files, failed_dirs + no_backup_dirs)
+    result = make_result('restore', working_directory, [folder for date, folder in restored_files], failed_dirs,
+                         metrics=metrics)
+    result['restored'] = [{'date': date, 'path': folder} for date, folder in restored_files]
+    result['no_backup'] = [path for path, error in no_backup_dirs]
+    return result
 
-    # Remove lines starting with $OBJECT_BUILDING
-    if os.path.exists(workshopconfig_path):
-        with open(workshopconfig_path, 'r') as f:
-            workshop_lines = f.readlines()
-        workshop_lines = [line for line in workshop_lines if not line.startswith('$OBJECT_BUILDING')]
+def undo_change(journal, store, writer, entry):
+    # Undo one journal entry. Returns the path it concerns and whether it
+    # was undone (False if it already was); raises ValueError if the file or
+    # folder changed since.
+    if 'rename' in entry:
+        path = journal.path(entry['rename'])
+        new_path = journal.path(entry['to'])
+        if os.path.exists(new_path):
+            if os.path.exists(path):
+                raise ValueError("{} exists again".format(path))
+            os.rename(new_path, path)
+            return path, True
+        if os.path.exists(path):
+            return path, False
+        raise ValueError("{} no longer exists".format(new_path))
+    path = journal.path(entry['edit'])
+    current = file_sha256(path) if os.path.exists(path) else None
+    if current == entry['before']:
+        return path, False
+    if current != entry['after']:
+        raise ValueError("changed since the run")
+    if entry['before'] is None:
+        os.remove(path)
     else:
-        workshop_lines = []
+        with open(store.object_path(entry['before']), 'rb') as f:
+            writer.write(path, f.read())
+    return path, True
 
-    # Index after $VISIBILITY
-    visibility_index = None
-    for i, line in enumerate(workshop_lines):
-        if line.startswith('$VISIBILITY'):
-            visibility_index = i + 1
-            break
-    if visibility_index is None:
-        workshop_lines.append('$VISIBILITY\n')
-        visibility_index = len(workshop_lines)
+def iter_undo(working_directory, run_id=None, durability='none', metrics=None, run_state=None):
+    # Undo a run (default: the last one not yet undone) from its journal,
+    # newest change first: edited files get their old content back and
+    # renamed folders their old name. Only what the journal lists is
+    # touched. Changes that were already undone are skipped, so an undo
+    # can be run again after a failure; a file or folder that changed since
+    # the run is left alone and reported as failed. Yields an asset_record
+    # for each change.
+    if metrics is None:
+        metrics = Metrics()
+    for counter in ('changes undone', 'changes skipped', 'changes failed'):
+        metrics.count(counter, 0)
+    own_state = run_state is None
+    if own_state:
+        run_state = RunState(working_directory, durability=durability)
+    journal = run_state.journal
+    if run_id is None:
+        # The last run that changed something in this working directory
+        for candidate in reversed(journal.run_ids()):
+            if any(journal.in_scope(entry, working_directory) for entry in journal.load(candidate)):
+                run_id = candidate
+                break
+        else:
+            raise ValueError("No run to undo in {}".format(working_directory))
+    in_scope = [(line_number, entry) for line_number, entry in enumerate(journal.load(run_id))
+                if journal.in_scope(entry, working_directory)]
+    update_log("iniconfig check: Undo run {}".format(run_id))
+    settled = []
+    try:
+        with metrics.phase('undo'):
+            for line_number, entry in reversed(in_scope):
+                try:
+                    path, undone = undo_change(journal, run_state.store, run_state.writer, entry)
+                except (OSError, ValueError) as e:
+                    metrics.count('changes failed')
+                    yield asset_record(relative_path(working_directory, journal.path(
+                        entry.get('edit', entry.get('rename')))), 'failed', e)
+                    continue
+                settled.append(line_number)
+                metrics.count('changes undone' if undone else 'changes skipped')
+                yield asset_record(relative_path(working_directory, path), 'undone' if undone else 'skipped')
+    finally:
+        journal.settle(run_id, settled)
+        if journal.base is not None:
+            # A shared journal is marked by run_roots once all roots are done
+            journal.mark_settled()
+        if own_state:
+            run_state.save(metrics)
 
-    for root, dirs, files in os.walk(working_directory):
-        if 'building.ini' in files:
-            try:
-                building_ini_path = os.path.join(root, 'building.ini')
-                backup_name = 'building.{date}.bak'.format(date=datetime.date.today().strftime("%Y%m%d"))
-                backup_path = os.path.join(root, backup_name)
-                shutil.copy2(building_ini_path, backup_path)
-
-                with open(building_ini_path, 'r') as f:
-                    lines = f.readlines()
-
-                # Extract $NAME_STR or $NAME
-                name_line = next((line for line in lines if line.startswith('$NAME_STR') or line.startswith('$NAME')), '').strip()
-                if name_line:
-                    asset_found = name_line.split(' ', 1)[1].strip('"')
-                else:
-                    asset_found = 'Unknown'
+def undo_run(working_directory, metrics=None, **options):
+    if metrics is None:
+        metrics = Metrics()
+    success_dirs = []
+    failed_dirs = []
+    skipped_dirs = []
+    for record in iter_undo(working_directory, metrics=metrics, **options):
+        if record['status'] == 'undone':
+            success_dirs.append(record['path'])
+        elif record['status'] == 'failed':
+            failed_dirs.append((record['path'], record['error']))
+        else:
+            skipped_dirs.append(record['path'])
+    return make_result('undo', working_directory, success_dirs, failed_dirs, skipped_dirs, metrics)
 
-                # Extract $TYPE and $SUBTYPE
-                type_line = next((line for line in lines if line.startswith('$TYPE')), '').strip()
-                subtype_line = next((line for line in lines if line.startswith('$SUBTYPE')), '').strip()
+def list_assets(working_directory, types=None, state=None, workers=1, executor='thread', max_depth=None,
+                metrics=None, run_state=None):
+    if metrics is None:
+        metrics = Metrics()
+    with metrics.phase('discover'):
+        assets = discover_assets(working_directory, max_depth)
+    asset_catalog = run_state.catalog if run_state is not None else Catalog(working_directory)
+    with metrics.phase('catalog'):
+        metrics.count('assets scanned', asset_catalog.refresh(assets, workers, executor, working_directory))
+        rows = asset_catalog.query(types, state, working_directory)
+    if run_state is None:
+        asset_catalog.close()
+    result = make_result('list', working_directory, [row['path'] for row in rows], [], metrics=metrics)
+    result['assets'] = rows
+    return result
 
-                type_value = type_line.split(' ')[0] if type_line else ''
-                subtype_value = subtype_line.split(' ')[0] if subtype_line else ''
+def is_archive(path):
+    return os.path.isfile(path) and zipfile.is_zipfile(path)
 
-                # Determine [TYPEORSUBTYPE]
-                # Use the same mappings as before
-                if (type_value, subtype_value) in type_subtype_names:
-                    type_or_subtype_name = type_subtype_names[(type_value, subtype_value)]
-                elif type_value in type_names:
-                    type_or_subtype_name = type_names[type_value]
-                else:
-                    type_or_subtype_name = 'Unknown'
+def archive_member_info(info, filename, date_time=None):
+    # A ZipInfo for writing a member like info under filename
+    new_info = zipfile.ZipInfo(filename, date_time or info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.comment = info.comment
+    new_info.create_system = info.create_system
+    new_info.external_attr = info.external_attr
+    new_info.file_size = info.file_size
+    return new_info
 
-                # For this example, ITEM_ID, ITEM_NAME, ITEM_DESC are not extracted
-                # Display the screen to the user
-                clear_screen()
-                print("-" * 80)
-                print("WRSR-INICONFIG | https://github.com/auhrs/wrsr-iniconfig/         (c) 2024 AUHRS")
-                print("-" * 80)
-                print("\nRENAME EACH ASSET INDIVIDUALLY")
-                print("Asset found:   {}".format(asset_found))
-                print("Type of asset: {}".format(type_or_subtype_name))
-                print("Asset ID:      https://steamcommunity.com/sharedfiles/filedetails/?id=")
-                print("\nItem:          ")
-                print("\nType in the asset's new name below and press ENTER to continue.\n")
-                print("Press CTRL+C to cancel all operations")
-                print("-" * 80)
-                new_name = input("Enter new asset name (suggested: {}): ".format(type_or_subtype_name)).strip()
-                if not new_name:
-                    new_name = type_or_subtype_name
-
-                # Remove specified lines
-                lines = [line for line in lines if not line.startswith((
-                    '$COST_WORK', '$COST_RESOURCE', '$NO_LIFESPAN', '$HEATING_DISABLE',
-                    '$WATERSEWAGE_DISABLE', '$WASTE_WORKERS_DISABLE', '$WASTE_CUSTOMERS_DISABLE',
-                    '$COUNT_LIMIT', '$ELETRIC_WITHOUT_WORKING_FACTOR',
-                    '$ELETRIC_WITHOUT_LIGHTING_FACTOR', '$NAME_STR', '$NAME'
-                ))]
-
-                # Insert $NAME_STR at the top
-                new_lines = ['$NAME_STR "{}"\n'.format(new_name)]
-                new_lines += [
-                    '$NO_LIFESPAN\n',
-                    '$HEATING_DISABLE\n',
-                    '$WATERSEWAGE_DISABLE\n',
-                    '$WASTE_WORKERS_DISABLE\n',
-                    '$WASTE_CUSTOMERS_DISABLE\n',
-                    '$COUNT_LIMIT 999\n',
-                    '$ELETRIC_WITHOUT_WORKING_FACTOR 1\n',
-                    '$ELETRIC_WITHOUT_LIGHTING_FACTOR 1\n'
-                ] + lines
-
-                with open(building_ini_path, 'w') as f:
-                    f.writelines(new_lines)
-
-                # Rename folder
-                random_number = str(random.randint(10000, 99999))
-                folder_name = '{}{}'.format(new_name, random_number)
-                folder_name = re.sub(r'\W+', '', folder_name)
-                parent_folder = os.path.dirname(root)
-                new_folder_path = os.path.join(parent_folder, folder_name)
-                os.rename(root, new_folder_path)
-
-                # Update workshopconfig.ini
-                dir_name = os.path.basename(new_folder_path)
-                workshop_lines.insert(visibility_index, '$OBJECT_BUILDING {}\n'.format(dir_name))
-                visibility_index += 1
-
-                success_dirs.append(os.path.relpath(new_folder_path, working_directory))
+def convert_archive(archive_path, operation, prefix='', names=None, output=None, metrics=None, types=None,
+                    profile=None, durability='none', **options):
+    # Convert the assets inside a zip archive into a new archive at output
+    # (default: NAME.converted.zip next to it). Only building.ini and
+    # workshopconfig.ini entries are read and rewritten; every other member
+    # is streamed from the old archive to the new one, under its new folder
+    # name if its asset was renamed. The old archive is the backup, so the
+    # backup store, --incremental and the catalog do not apply. An asset
+    # whose building.ini cannot be read is left out of the new archive with
+    # its workshopconfig.ini entry. output may be the archive itself, which
+    # is then replaced once the new one is complete.
+    if operation not in ('modify', 'rename-by-type', 'rename-individually'):
+        raise ValueError("{} does not work on archives".format(operation))
+    if metrics is None:
+        metrics = Metrics()
+    if output is None:
+        output = os.path.splitext(archive_path)[0] + '.converted.zip'
+    names = names or {}
+    types = set(normalize_type(value) for value in types or ())
+    update_log("iniconfig check: {} in archive {}".format(operation, archive_path))
+    success_dirs = []
+    failed_dirs = []
+    # New content of edited members, by member name
+    edited = {}
+    # Assets whose building.ini could not be read, left out of the output
+    omitted = set()
+    temp_path = '{}.{}.tmp'.format(output, os.getpid())
+    with zipfile.ZipFile(archive_path) as archive:
+        infos = archive.infolist()
+        with metrics.phase('discover'):
+            # Asset folders, without assets inside other assets
+            found = set(posixpath.dirname(info.filename) for info in infos
+                        if posixpath.basename(info.filename) == 'building.ini')
+            roots = []
+            for root in sorted(found):
+                parts = root.split('/') if root else []
+                if not any('/'.join(parts[:depth]) in found for depth in range(len(parts))):
+                    roots.append(root)
+        metrics.count('assets found', len(roots))
+
+        pending = []
+        for root in roots:
+            member = posixpath.join(root, 'building.ini')
+            timings = {}
+            start = time.perf_counter()
+            try:
+                # A corrupt or encrypted member only fails its own asset
+                data = archive.read(member)
+            except Exception as e:
+                metrics.count('assets failed')
+                failed_dirs.append((root, str(e)))
+                omitted.add(root)
+                continue
+            timings['read'] = time.perf_counter() - start
+            start = time.perf_counter()
+            try:
+                ini = BuildingIni(data)
+                if types:
+                    type_entry = ini.get('$TYPE')
+                    if type_entry is None or type_entry.directive not in types:
+                        continue
+                new_name = names.get(root, names.get(posixpath.basename(root))) or None
+                new_name = asset_new_name(ini, operation, prefix, new_name)
+                new_data = (profile or FREE).apply(ini, new_name)
             except Exception as e:
-                failed_dirs.append((os.path.relpath(root, working_directory), str(e)))
+                metrics.count('assets failed')
+                failed_dirs.append((root, str(e)))
+                continue
+            timings['transform'] = time.perf_counter() - start
+            metrics.asset(root, timings)
+            metrics.count('bytes read', len(data))
+            if new_data != data:
+                edited[member] = new_data
+            pending.append((root, new_name))
 
-    # Write updated workshopconfig.ini
-    with open(workshopconfig_path, 'w') as f:
-        f.writelines(workshop_lines)
+        # Folder renames as a prefix map over member names
+        renamed = {}
+        if operation != 'modify' and pending:
+            children = {}
+            for info in infos:
+                parts = info.filename.rstrip('/').split('/')
+                for depth in range(len(parts)):
+                    children.setdefault('/'.join(parts[:depth]), set()).add(parts[depth])
+            # An asset at the top of the archive has no folder to rename
+            targets = plan_folder_names(pending, lambda folder: children.get(folder if folder != '.' else '', ()),
+                                        posixpath, keep='')
+            for (root, new_name), target in zip(pending, targets):
+                if target != root:
+                    renamed[root] = target
+        for root, new_name in pending:
+            success_dirs.append(renamed.get(root, root))
+        metrics.count('assets converted', len(pending))
 
-    display_report(working_directory, success_dirs, failed_dirs)
+        def is_omitted(filename):
+            parts = filename.rstrip('/').split('/')
+            return any('/'.join(parts[:depth]) in omitted for depth in range(len(parts) + 1))
 
-def restore_backups(working_directory):
-    restored_files = []
-    no_backup_dirs = []
-    log_message = "iniconfig check: Restored backups"
-    update_log(log_message)
-    for root, dirs, files in os.walk(working_directory):
-        backup_files = [f for f in files if re.match(r'building\.\d{8}\.bak', f)]
-        if backup_files:
-            for backup_file in backup_files:
-                try:
-                    backup_path = os.path.join(root, backup_file)
-                    building_ini_path = os.path.join(root, 'building.ini')
-                    if os.path.exists(building_ini_path):
-                        os.remove(building_ini_path)
-                    shutil.copy2(backup_path, building_ini_path)
-                    date_str = backup_file.split('.')[1]
-                    date_formatted = datetime.datetime.strptime(date_str, '%Y%m%d').strftime('%Y-%m-%d')
-                    restored_files.append((date_formatted, os.path.relpath(root, working_directory)))
-                    update_log("Restored backup {} as building.ini".format(backup_file))
-                except Exception as e:
-                    no_backup_dirs.append((os.path.relpath(root, working_directory), str(e)))
-        else:
-            no_backup_dirs.append((os.path.relpath(root, working_directory), "No backup file found"))
-    display_restore_report(working_directory, restored_files, no_backup_dirs)
+        def new_member_name(filename):
+            # Members below a renamed asset folder move with it
+            parts = filename.split('/')
+            for depth in range(len(parts) - 1, 0, -1):
+                folder = '/'.join(parts[:depth])
+                if folder in renamed:
+                    return '/'.join([renamed[folder]] + parts[depth:])
+            return filename
+
+        if operation != 'modify' or omitted:
+            with metrics.phase('workshopconfig'):
+                # Each workshopconfig.ini lists the assets in its folder and below
+                for info in infos:
+                    if posixpath.basename(info.filename) != 'workshopconfig.ini' or is_omitted(info.filename):
+                        continue
+                    folder = posixpath.dirname(info.filename)
+                    base = folder + '/' if folder else ''
+                    workshop_config = WorkshopConfig('', archive.read(info))
+                    if operation == 'modify':
+                        # Only the entries of assets left out are dropped
+                        listed = [name for name in workshop_config.buildings() if base + name not in omitted]
+                    else:
+                        listed = [renamed.get(root, root)[len(base):] for root in roots
+                                  if root.startswith(base) and root != folder and root not in omitted]
+                    local_renames = dict((root[len(base):], target[len(base):])
+                                         for root, target in renamed.items() if root.startswith(base))
+                    if workshop_config.reconcile(listed, local_renames):
+                        edited[info.filename] = workshop_config.serialize()
+
+        start = time.perf_counter()
+        try:
+            with zipfile.ZipFile(temp_path, 'w', allowZip64=True) as converted:
+                converted.comment = archive.comment
+                for info in infos:
+                    filename = new_member_name(info.filename)
+                    if is_omitted(info.filename):
+                        metrics.count('members skipped')
+                    elif info.filename in edited:
+                        data = edited[info.filename]
+                        converted.writestr(archive_member_info(info, filename, time.localtime()[:6]), data)
+                        metrics.count('files written')
+                        metrics.count('bytes written', len(data))
+                    elif info.is_dir():
+                        converted.writestr(archive_member_info(info, filename), b'')
+                    else:
+                        with archive.open(info) as source, converted.open(
+                                archive_member_info(info, filename), 'w', force_zip64=info.file_size > 2 ** 31) as target:
+                            shutil.copyfileobj(source, target, 1024 * 1024)
+                        metrics.count('members copied')
+                if durability != 'none':
+                    converted.fp.flush()
+                    os.fsync(converted.fp.fileno())
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    metrics.add_time('write archive', time.perf_counter() - start)
+    os.replace(temp_path, output)
+    if durability != 'none':
+        fsync_directory(os.path.dirname(output) or '.')
+    result = make_result(operation, archive_path, success_dirs, failed_dirs, metrics=metrics)
+    result['output'] = output
+    return result
+
+class WatchIndex:
+    # The folders below the working directory as of the last poll, kept in
+    # .iniconfig/watch.json. Adding, removing or replacing an entry changes
+    # a folder's mtime, so a folder whose mtime and inode are unchanged is
+    # not listed again: its subfolders are taken from the index, and of an
+    # asset folder only building.ini is stat'ed, for in-place edits.
+    def __init__(self, working_directory, max_depth=None):
+        self.working_directory = working_directory
+        self.max_depth = max_depth
+        self.path = os.path.join(working_directory, STATE_DIRNAME, 'watch.json')
+        # {key: [mtime_ns, inode, [subfolder names]]}
+        self.folders = {}
+        # {key: [mtime_ns, inode, building.ini size, mtime_ns, inode]}
+        self.assets = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == 1:
+                self.folders = data['folders']
+                self.assets = data['assets']
+
+    @staticmethod
+    def stat_building_ini(root):
+        try:
+            stat = os.stat(os.path.join(root, 'building.ini'))
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def poll(self):
+        # Walk the tree as iter_assets does and return the roots of the
+        # assets that are new or whose building.ini changed since the last poll
+        folders = {}
+        assets = {}
+        changed = []
+        pending = [(self.working_directory, 0)]
+        while pending:
+            path, depth = pending.pop()
+            key = relative_key(self.working_directory, path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature = [stat.st_mtime_ns, stat.st_ino]
+            descend = self.max_depth is None or depth < self.max_depth
+            folder = self.folders.get(key)
+            if folder is not None and folder[:2] == signature:
+                folders[key] = folder
+                if descend:
+                    pending.extend((os.path.join(path, name), depth + 1) for name in folder[2])
+                continue
+            asset = self.assets.get(key)
+            if asset is not None and asset[:2] == signature:
+                building_ini = self.stat_building_ini(path)
+                if building_ini is not None:
+                    assets[key] = signature + building_ini
+                    if building_ini != asset[2:]:
+                        changed.append(path)
+                continue
+            # New or changed folder
+            subfolders = []
+            is_asset = False
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name != STATE_DIRNAME:
+                                subfolders.append(entry.name)
+                        elif entry.name == 'building.ini' or BACKUP_PATTERN.match(entry.name):
+                            is_asset = True
+            except OSError:
+                continue
+            if is_asset:
+                building_ini = self.stat_building_ini(path)
+                if building_ini is not None:
+                    assets[key] = signature + building_ini
+                    if asset is None or building_ini != asset[2:]:
+                        changed.append(path)
+                else:
+                    # Only backups: nothing to convert, nothing below it to look at
+                    folders[key] = signature + [[]]
+                continue
+            subfolders.sort()
+            folders[key] = signature + [subfolders]
+            if descend:
+                pending.extend((os.path.join(path, name), depth + 1) for name in subfolders)
+        self.folders = folders
+        self.assets = assets
+        return changed
+
+    def refresh(self, roots):
+        # Take the current state of roots, e.g. after converting them, so the
+        # next poll does not report the run's own writes
+        for root in roots:
+            key = relative_key(self.working_directory, root)
+            building_ini = self.stat_building_ini(root)
+            if key not in self.assets or building_ini is None:
+                continue
+            stat = os.stat(root)
+            self.assets[key] = [stat.st_mtime_ns, stat.st_ino] + building_ini
+
+    def save(self, writer):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = json.dumps({'version': 1, 'folders': self.folders, 'assets': self.assets}).encode('utf-8')
+        writer.write(self.path, data)
+
+def watch_assets(working_directory, interval=5.0, debounce=2.0, max_passes=None, metrics=None,
+                 max_depth=None, durability='none', **options):
+    # Poll the working directory every interval seconds and modify the
+    # asset folders that appeared or changed, as --incremental would. Changes
+    # are collected until none came in for debounce seconds and are then
+    # converted in one pass. Yields the result of each pass; metrics only
+    # supplies the settings and hooks of the metrics of each pass.
+    index = WatchIndex(working_directory, max_depth)
+    pending = {}
+    last_change = None
+    passes = 0
+    while max_passes is None or passes < max_passes:
+        changed = index.poll()
+        now = time.monotonic()
+        if changed:
+            pending.update(dict.fromkeys(changed))
+            last_change = now
+        if pending and now - last_change >= debounce:
+            roots = list(pending)
+            pending.clear()
+            if metrics is None:
+                pass_metrics = Metrics()
+            else:
+                pass_metrics = Metrics(metrics.slow_asset_seconds, metrics.slow_asset_limit, metrics.hooks)
+            update_log("iniconfig check: Modify building.ini only ({} changed assets)".format(len(roots)))
+            success_dirs, failed_dirs, skipped_dirs = convert_free_buildings(
+                working_directory, 'modify', incremental=True, metrics=pass_metrics, max_depth=max_depth,
+                durability=durability, roots=roots, **options)
+            writer = FileWriter(durability)
+            index.refresh(roots)
+            index.save(writer)
+            writer.commit()
+            LOG.flush()
+            passes += 1
+            yield make_result('modify', working_directory, success_dirs, failed_dirs, skipped_dirs, pass_metrics)
+        time.sleep(interval)
 
-def display_report(working_directory, success_dirs, failed_dirs):
+def display_report(working_directory, success_dirs, failed_dirs, skipped_dirs=()):
+    LOG.flush()
     clear_screen()
     print("-" * 80)
     print("WRSR-INICONFIG | https://github.com/auhrs/wrsr-iniconfig/         (c) 2024 AUHRS")
@@ -564,11 +3059,14 @@ def display_report(working_directory, success_dirs, failed_dirs):
         print("The following directories were modified successfully:")
         for dir in success_dirs:
             print(dir)
+    if skipped_dirs:
+        print("\n{} directories were unchanged since the last run and were skipped.".format(len(skipped_dirs)))
     print("\nPress CTRL+C to cancel all operations")
     print("-" * 80)
     input("Press ENTER to return to the main menu...")
 
 def display_restore_report(working_directory, restored_files, no_backup_dirs):
+    LOG.flush()
     clear_screen()
     print("-" * 80)
     print("WRSR-INICONFIG | https://github.com/auhrs/wrsr-iniconfig/         (c) 2024 AUHRS")